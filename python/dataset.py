@@ -17,6 +17,10 @@
 
 
 from typing import Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import numpy as np
 import os
 import struct
@@ -119,8 +123,30 @@ class Dataset(object):
             path: str,
             device_type: DeviceType,
             criteria={},
-            filter: bool = False):
-        """ """
+            filter: bool = False,
+            cache: bool = False,
+            workers: int = 1,
+            lazy: bool = False,
+            cache_bytes: int = 256 << 20):
+        """Load every sample under path/<subject>/<gesture>/<file>.
+
+        Subjects are visited in sorted order and numbered (pid) in that
+        order. With workers > 1, subject directories are listed and parsed
+        in a thread pool, which hides per-file latency on network storage;
+        the result is identical to a serial load.
+
+        With cache=True, the loaded (and optionally filtered) samples are
+        written to a consolidated cache next to the dataset directory the
+        first time, and memory mapped on later runs. The cache is keyed by
+        path, criteria and filter, and is rebuilt whenever a source file is
+        added, removed or modified.
+
+        With lazy=True, only file paths and headers are read. Trajectories
+        and time stamps are decoded (and filtered) on first access and kept
+        in an LRU of at most cache_bytes, so resident memory follows the
+        samples in use, e.g., the current ud/ui fold, rather than the size
+        of the corpus. The disk cache is not used in lazy mode.
+        """
         #
         # Get path to dataset if not specified.
         #
@@ -135,18 +161,76 @@ class Dataset(object):
         assert os.path.exists(path)
         assert os.path.isdir(path)
 
+        entries = Dataset.Index(path, criteria, workers)
+
+        if lazy:
+            store = TrajectoryCache(cache_bytes)
+            tasks = [entry + (store,) for entry in entries]
+            with Dataset.Executor(workers) as executor:
+                samples = list(executor.map(Sample.Index, tasks))
+
+            ret = cls(samples, device_type)
+            ret.path = path
+
+            if filter:
+                ret.run_filter()
+
+            return ret
+
+        samples = None
+        if cache:
+            cache_path = Dataset.CachePath(path, criteria, filter)
+            stamp = Dataset.Stamp(entries, workers)
+            samples = Dataset.LoadCache(cache_path, stamp)
+
+        if samples is not None:
+            print("Load", cache_path)
+            ret = cls(samples, device_type)
+            ret.path = path
+            return ret
+
+        #
+        # Parse one subject per task; map keeps subject order, so pid
+        # assignment and sample order match a serial load.
+        #
+        groups = {}
+        for entry in entries:
+            groups.setdefault(entry[0], []).append(entry)
+
+        samples = []
+        with Dataset.Executor(workers) as executor:
+            for subject in executor.map(Dataset.LoadSubject, groups.values()):
+                print("Load", subject[0].sname)
+                samples += subject
+
+        ret = cls(samples, device_type)
+        ret.path = path
+
+        if filter:
+            ret.run_filter()
+
+        if cache:
+            Dataset.SaveCache(cache_path, stamp, samples)
+
+        return ret
+
+    @classmethod
+    def Index(
+            cls,
+            path: str,
+            criteria={},
+            workers: int = 1):
+        """List (sname, gname, ename, epath, pid) for every sample file."""
+
         #
         # Setup criteria...
         # Note, 'g'=gesture and 's'=subject
         #
-        gexclude = criteria.get('gexclude', [])
-        ginclude = criteria.get('ginclude', [])
         sexclude = criteria.get('sexclude', [])
         sinclude = criteria.get('sinclude', [])
 
-        pid = 0
-        samples = []
-        for sname in os.listdir(path):
+        snames = []
+        for sname in sorted(os.listdir(path)):
 
             spath = path + "/" + sname
             if not os.path.isdir(spath):
@@ -158,40 +242,163 @@ class Dataset(object):
             if len(sinclude) and sname not in sinclude:
                 continue
 
-            print("Load", sname)
+            snames += [sname]
 
-            for gname in os.listdir(spath):
+        tasks = [(path, sname, pid, criteria)
+                 for pid, sname in enumerate(snames)]
 
-                gpath = spath + "/" + gname
-                if gname in gexclude:
-                    continue
+        entries = []
+        with Dataset.Executor(workers) as executor:
+            for subject in executor.map(Dataset.IndexSubject, tasks):
+                entries += subject
 
-                if len(ginclude) and gname not in ginclude:
-                    continue
+        return entries
 
-                if not os.path.isdir(gpath):
-                    continue
+    @staticmethod
+    def IndexSubject(task):
+        """List the sample files of one subject directory."""
+        path, sname, pid, criteria = task
 
-                for ename in os.listdir(gpath):
-                    epath = gpath + "/" + ename
-                    sample = Sample.Load(
-                        sname,
-                        gname,
-                        ename,
-                        epath,
-                        pid)
+        gexclude = criteria.get('gexclude', [])
+        ginclude = criteria.get('ginclude', [])
 
-                    samples += [sample]
+        spath = path + "/" + sname
+        entries = []
+        for gname in sorted(os.listdir(spath)):
 
-            pid += 1
+            gpath = spath + "/" + gname
+            if gname in gexclude:
+                continue
 
-        ret = cls(samples, device_type)
-        ret.path = path
+            if len(ginclude) and gname not in ginclude:
+                continue
 
-        if filter:
-            ret.run_filter()
+            if not os.path.isdir(gpath):
+                continue
 
-        return ret
+            for ename in sorted(os.listdir(gpath)):
+                epath = gpath + "/" + ename
+                entries += [(sname, gname, ename, epath, pid)]
+
+        return entries
+
+    @staticmethod
+    def LoadSubject(entries):
+        """Parse the sample files of one subject."""
+        return [Sample.Load(sname, gname, ename, epath, pid)
+                for sname, gname, ename, epath, pid in entries]
+
+    @staticmethod
+    def Executor(workers: int = 1):
+        """Thread pool for workers > 1, otherwise an in-line executor."""
+        if workers > 1:
+            return ThreadPoolExecutor(max_workers=workers)
+        return _SerialExecutor()
+
+    @classmethod
+    def CachePath(
+            cls,
+            path: str,
+            criteria={},
+            filter: bool = False) -> str:
+        """Cache directory for a dataset path, criteria and filter."""
+        path = os.path.normpath(os.path.realpath(path))
+        key = json.dumps(
+            [path, sorted((k, sorted(v)) for k, v in criteria.items()),
+             bool(filter)])
+        key = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(
+            os.path.dirname(path),
+            ".cache",
+            "{}-{}".format(os.path.basename(path), key))
+
+    @classmethod
+    def Stamp(cls, entries, workers: int = 1) -> str:
+        """Digest of the file listing, file sizes and modification times."""
+        with Dataset.Executor(workers) as executor:
+            stats = list(executor.map(os.stat, [e[3] for e in entries]))
+
+        digest = hashlib.sha1()
+        for (sname, gname, ename, epath, pid), st in zip(entries, stats):
+            digest.update("{}\0{}\0{}\0{}\n".format(
+                epath, pid, st.st_mtime_ns, st.st_size).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def SaveCache(
+            cls,
+            cache_path: str,
+            stamp: str,
+            samples) -> None:
+        """Write samples as one flat trajectory array plus metadata."""
+        os.makedirs(cache_path, exist_ok=True)
+
+        # Invalidate first so a partial write is never picked up.
+        stamp_path = os.path.join(cache_path, "stamp")
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+
+        shapes = np.array(
+            [s.trajectory.shape for s in samples],
+            dtype=np.int64).reshape(-1, 2)
+        points = np.concatenate(
+            [np.ravel(s.trajectory) for s in samples] + [np.empty(0)])
+        time_s = np.concatenate(
+            [np.ravel(s.time_s) for s in samples] + [np.empty(0)])
+        pids = np.array([s.pid for s in samples], dtype=np.int64)
+        names = np.array(
+            [[s.sname, s.gname, s.ename, s.fname] for s in samples],
+            dtype=np.str_).reshape(-1, 4)
+
+        np.save(os.path.join(cache_path, "points.npy"), points)
+        np.save(os.path.join(cache_path, "time_s.npy"), time_s)
+        np.save(os.path.join(cache_path, "shapes.npy"), shapes)
+        np.save(os.path.join(cache_path, "pids.npy"), pids)
+        np.save(os.path.join(cache_path, "names.npy"), names)
+
+        with open(stamp_path, "w") as fout:
+            fout.write(stamp)
+
+    @classmethod
+    def LoadCache(
+            cls,
+            cache_path: str,
+            stamp: str):
+        """Memory map cached samples, or None if the cache is stale."""
+        stamp_path = os.path.join(cache_path, "stamp")
+        if not os.path.exists(stamp_path):
+            return None
+
+        with open(stamp_path, "r") as fin:
+            if fin.read() != stamp:
+                return None
+
+        points = np.load(
+            os.path.join(cache_path, "points.npy"), mmap_mode='r')
+        time_s = np.load(
+            os.path.join(cache_path, "time_s.npy"), mmap_mode='r')
+        shapes = np.load(os.path.join(cache_path, "shapes.npy"))
+        pids = np.load(os.path.join(cache_path, "pids.npy"))
+        names = np.load(os.path.join(cache_path, "names.npy")).tolist()
+
+        sizes = shapes[:, 0] * shapes[:, 1]
+        offsets = np.concatenate(([0], np.cumsum(sizes))).tolist()
+        toffsets = np.concatenate(([0], np.cumsum(shapes[:, 0]))).tolist()
+
+        samples = []
+        for ii, (sname, gname, ename, fname) in enumerate(names):
+            trajectory = points[offsets[ii]:offsets[ii + 1]]
+            sample = Sample(
+                sname,
+                gname,
+                ename,
+                int(pids[ii]),
+                trajectory.reshape(shapes[ii]),
+                time_s[toffsets[ii]:toffsets[ii + 1]])
+            sample.fname = fname
+            samples += [sample]
+
+        return samples
 
     def ud(
             self,
@@ -227,9 +434,89 @@ class Dataset(object):
                 yield train, test
 
     def run_filter(self):
+        #
+        # Filter samples of the same shape together in one batch.
+        #
+        batches = {}
         for sample in self.samples:
-            r = utils.get_cma_r(30.0, 3.0)
-            sample.trajectory = utils.rcma(sample.trajectory, 1, r)
+            if sample.store is not None:
+                sample.store.set_filter(True)
+                continue
+            shape = np.shape(sample.trajectory)
+            batches.setdefault(shape, []).append(sample)
+
+        r = utils.get_cma_r(30.0, 3.0)
+        for samples in batches.values():
+            filtered = utils.rcma_batch(
+                [sample.trajectory for sample in samples], 1, r)
+            for sample, trajectory in zip(samples, filtered):
+                sample.trajectory = trajectory
+
+    @staticmethod
+    def Filter(trajectory):
+        """Smooth a trajectory with the recursive centered moving average."""
+        r = utils.get_cma_r(30.0, 3.0)
+        return utils.rcma(trajectory, 1, r)
+
+
+class _SerialExecutor(object):
+    """Executor stand-in that runs map() in the calling thread."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def map(self, fn, *iterables):
+        return map(fn, *iterables)
+
+
+class TrajectoryCache(object):
+    """Byte-bounded LRU of decoded (trajectory, time_s) pairs.
+
+    Lazy samples keep only their file path and header; this cache decodes
+    them on demand and evicts the least recently used entries once the
+    decoded arrays exceed max_bytes. The most recent entry is always kept.
+    """
+
+    def __init__(self, max_bytes: int):
+        """ """
+        self.max_bytes = max_bytes
+        self.filter = False
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def set_filter(self, filter: bool):
+        """Filter on decode; drops entries decoded with the old setting."""
+        if filter != self.filter:
+            self.filter = filter
+            self.clear()
+
+    def clear(self):
+        """ """
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, sample) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (trajectory, time_s) of sample, decoding if needed."""
+        key = sample.fname
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        trajectory, time_s = Sample.Decode(key)
+        if self.filter:
+            trajectory = Dataset.Filter(trajectory)
+
+        self.entries[key] = (trajectory, time_s)
+        self.nbytes += trajectory.nbytes + time_s.nbytes
+
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, (old_trajectory, old_time_s) = self.entries.popitem(last=False)
+            self.nbytes -= old_trajectory.nbytes + old_time_s.nbytes
+
+        return trajectory, time_s
 
 
 class Sample(object):
@@ -248,8 +535,31 @@ class Sample(object):
         self.gname = gname
         self.ename = ename
         self.pid = pid
-        self.trajectory = trajectory
-        self.time_s = time_s
+        self.store = None
+        self._trajectory = trajectory
+        self._time_s = time_s
+
+    @property
+    def trajectory(self):
+        """ """
+        if self._trajectory is None and self.store is not None:
+            return self.store.get(self)[0]
+        return self._trajectory
+
+    @trajectory.setter
+    def trajectory(self, trajectory):
+        self._trajectory = trajectory
+
+    @property
+    def time_s(self):
+        """ """
+        if self._time_s is None and self.store is not None:
+            return self.store.get(self)[1]
+        return self._time_s
+
+    @time_s.setter
+    def time_s(self, time_s):
+        self._time_s = time_s
 
     def __iter__(self):
         """ """
@@ -271,72 +581,100 @@ class Sample(object):
             epath,
             pid):
         """ """
-        trajectory = []
-        times_s = []
+        trajectory, times_s = Sample.Decode(epath)
+
+        ret = cls(
+            sname,
+            gname,
+            ename,
+            pid,
+            trajectory,
+            times_s)
+
+        ret.fname = epath
+
+        return ret
+
+    @classmethod
+    def Index(cls, task):
+        """Create a lazy sample from its header; see TrajectoryCache."""
+        sname, gname, ename, epath, pid, store = task
 
         with open(epath, "rb") as fin:
+            _gname, speed, pt_cnt, component_cnt = Sample.ReadHeader(fin)
+
+        ret = cls(
+            sname,
+            gname,
+            ename,
+            pid,
+            None,
+            None)
 
-            str_cnt, = struct.unpack(
-                "<B",
-                fin.read(1))
+        ret.fname = epath
+        ret.store = store
+        ret.pt_cnt = pt_cnt
+        ret.component_cnt = component_cnt
 
-            _gname, = struct.unpack(
-                "{}s".format(str_cnt),
-                fin.read(str_cnt))
+        return ret
 
-            speed, pt_cnt, component_cnt = struct.unpack(
-                "<III",
-                fin.read(4 * 3))
+    @staticmethod
+    def ReadHeader(fin):
+        """Read (gname, speed, pt_cnt, component_cnt) from a sample file."""
+        str_cnt, = struct.unpack(
+            "<B",
+            fin.read(1))
 
-            #
-            # Load trajectory
-            #
-            bad = []
-            for pt_no in range(pt_cnt):
-                pt = []
-                for component_no in range(component_cnt):
-                    val, = struct.unpack(
-                        "<f",
-                        fin.read(4))
-                    pt += [val]
+        _gname, = struct.unpack(
+            "{}s".format(str_cnt),
+            fin.read(str_cnt))
 
-                if np.count_nonzero(pt) == 0:
-                    bad += [pt_no]
-                    continue
+        speed, pt_cnt, component_cnt = struct.unpack(
+            "<III",
+            fin.read(4 * 3))
 
-                if len(trajectory) and np.array_equal(trajectory[-1], pt):
-                    bad += [pt_no]
-                    continue
+        return _gname, speed, pt_cnt, component_cnt
 
-                trajectory += [np.array(pt)]
+    @staticmethod
+    def Decode(epath) -> Tuple[np.ndarray, np.ndarray]:
+        """Read the trajectory and time stamps of a sample file."""
+        with open(epath, "rb") as fin:
+
+            _gname, speed, pt_cnt, component_cnt = Sample.ReadHeader(fin)
+
+            #
+            # Load trajectory in one read
+            #
+            trajectory = np.frombuffer(
+                fin.read(4 * pt_cnt * component_cnt),
+                dtype="<f4")
+            trajectory = trajectory.reshape(pt_cnt, component_cnt)
 
             #
-            # Load time stamps
+            # Load time stamps in one read
             #
             timestamp_cnt, = struct.unpack(
                 "<I",
                 fin.read(4))
             assert timestamp_cnt == pt_cnt
 
-            for pt_no in range(timestamp_cnt):
-
-                val, = struct.unpack(
-                    "<f",
-                    fin.read(4))
-                if pt_no in bad:
-                    continue
-                times_s += [val]
+            times_s = np.frombuffer(
+                fin.read(4 * timestamp_cnt),
+                dtype="<f4")
 
-            assert len(times_s) == len(trajectory)
-
-        ret = cls(
-            sname,
-            gname,
-            ename,
-            pid,
-            np.array(trajectory),
-            np.array(times_s))
+        #
+        # Drop frames that are all zero (dropped by the device) or that
+        # repeat the last kept frame. A repeated frame always equals the
+        # previous nonzero frame, so comparing against that one is enough.
+        #
+        keep = np.any(trajectory != 0, axis=1)
+        nonzero = np.flatnonzero(keep)
+        repeated = np.all(
+            trajectory[nonzero[1:]] == trajectory[nonzero[:-1]],
+            axis=1)
+        keep[nonzero[1:][repeated]] = False
 
-        ret.fname = epath
+        trajectory = trajectory[keep].astype(np.float64)
+        times_s = times_s[keep].astype(np.float64)
 
-        return ret
+        return trajectory, times_s
@@ -17,9 +17,10 @@
 
 
 from typing import List, Union
+from collections import OrderedDict
 import numpy as np
 from dataset import Sample
-from utils import uniform_resample, norm_comp_len, norm_diagonal
+from utils import uniform_resample, uniform_resample_many, norm_comp_len, norm_diagonal
 from stats import RecognitionResult
 from tables import DeviceType, get_device_resample_count
 
@@ -38,12 +39,15 @@ class Jackknife(object):
 
         def __init__(self,
                      sample: Sample,
-                     n: int):
-            """ """
+                     n: int,
+                     pts: np.ndarray = None):
+            """Resample sample to n points, unless pts already are"""
             self.gname = sample.gname
             self.sample = sample
 
-            self.pts = uniform_resample(sample.trajectory, n)
+            if pts is None:
+                pts = uniform_resample(sample.trajectory, n)
+            self.pts = pts
             self.vecs = self.vectorize(self.pts)
 
             # Component-wise absolute distance (along each axis)
@@ -52,18 +56,90 @@ class Jackknife(object):
             # Normalized size of bounding box
             self.bb = norm_diagonal(self.pts)
 
+            # Lower and upper envelopes of vecs, per DTW window
+            self.envelopes = {}
+
+            # GPSR n for synthetic positives, see synthetic.template_gpsr_ns
+            self.gpsr_n = None
+
+        def envelope(self, window: int):
+            """Component-wise (lower, upper) of vecs over each band row.
+
+            Row i holds the minimum and maximum of vecs[i - window] through
+            vecs[i + window], the template vectors a candidate's i-th vector
+            can be matched with.
+            """
+            if window not in self.envelopes:
+                vecs = self.vecs
+                lower = vecs.copy()
+                upper = vecs.copy()
+                for shift in range(1, min(window, len(vecs) - 1) + 1):
+                    np.minimum(lower[:-shift], vecs[shift:],
+                               out=lower[:-shift])
+                    np.minimum(lower[shift:], vecs[:-shift],
+                               out=lower[shift:])
+                    np.maximum(upper[:-shift], vecs[shift:],
+                               out=upper[:-shift])
+                    np.maximum(upper[shift:], vecs[:-shift],
+                               out=upper[shift:])
+                self.envelopes[window] = (lower, upper)
+            return self.envelopes[window]
+
+        @property
+        def nbytes(self) -> int:
+            """Bytes held by the template's arrays, envelopes included"""
+            ret = self.pts.nbytes + self.vecs.nbytes
+            ret += np.asarray(self.abs).nbytes + np.asarray(self.bb).nbytes
+            for lower, upper in self.envelopes.values():
+                ret += lower.nbytes + upper.nbytes
+            return ret
+
+        @classmethod
+        def Batch(cls,
+                  samples: List[Sample],
+                  n: int) -> List['Jackknife.Template']:
+            """Templates of many samples; equal length ones are resampled
+            together"""
+            groups = {}
+            for idx, sample in enumerate(samples):
+                shape = np.shape(sample.trajectory)
+                groups.setdefault(shape, []).append(idx)
+
+            ret = [None] * len(samples)
+            for idxs in groups.values():
+                batch = uniform_resample_many(
+                    [samples[idx].trajectory for idx in idxs], n)
+                for idx, pts in zip(idxs, batch):
+                    ret[idx] = cls(samples[idx], n, pts)
+            return ret
+
+        @classmethod
+        def Cached(cls,
+                   samples: List[Sample],
+                   n: int) -> List['Jackknife.Template']:
+            """Templates of samples, reusing those built before; see
+            TemplateCache"""
+            cache = Jackknife.template_cache
+            ret = [cache.get(sample, n) for sample in samples]
+            missing = [idx for idx, t in enumerate(ret) if t is None]
+            if missing:
+                built = cls.Batch([samples[idx] for idx in missing], n)
+                for idx, template in zip(missing, built):
+                    cache.put(template, n)
+                    ret[idx] = template
+            return ret
+
         @staticmethod
-        def vectorize(pts: Union[np.ndarray, list]):
-            """Vectorize points"""
-
-            vecs = []
-            for i in range(1, len(pts)):
-                vec = pts[i] - pts[i - 1]
-                length = np.linalg.norm(vec)
-                if length == 0.0:
-                    vecs += [vec]
-                    continue
-                vecs += [vec / length]
+        def vectorize(pts: Union[np.ndarray, list]) -> np.ndarray:
+            """Vectorize points
+
+            Normalized between-point vectors; zero-length ones stay zero.
+            Also vectorizes a (k, n, d) stack.
+            """
+
+            vecs = np.diff(np.asarray(pts, dtype=float), axis=-2)
+            length = np.linalg.norm(vecs, axis=-1, keepdims=True)
+            np.divide(vecs, length, out=vecs, where=length != 0.0)
             return vecs
 
     def __init__(self,
@@ -84,13 +160,76 @@ class Jackknife(object):
         self.rejection_threshold = np.inf
         self.device_type = device_type
 
+        # Objects whose template_added(recognizer, tidx) is called after
+        # each new template, such as synthetic.IncrementalThreshold
+        self.observers = []
+
+        # Template comparisons made by classify, and how many of them were
+        # pruned by a lower bound or abandoned during DTW
+        self.compared_cnt = 0
+        self.pruned_cnt = 0
+        self.abandoned_cnt = 0
+
+        # Contiguous template store, one row per template: vecs and
+        # envelopes are (T, n - 1, d), abs and bb are (T, d), and gids
+        # index gnames. Rows past len(self.templates) are spare capacity.
+        self.gnames = []
+        self.template_vecs = None
+        self.template_lower = None
+        self.template_upper = None
+        self.template_abs = None
+        self.template_bb = None
+        self.template_gids = None
+
     def __iadd__(self, sample: Sample):
         """Add Jackknife template based on Sample"""
-        template = Jackknife.Template(sample, self.resample_cnt)
+        template, = Jackknife.Template.Cached([sample], self.resample_cnt)
+
+        tidx = len(self.templates)
+        self.reserve(tidx + 1, template.vecs.shape[-1])
+
+        if template.gname not in self.gnames:
+            self.gnames += [template.gname]
+
+        lower, upper = template.envelope(self.window)
+        self.template_vecs[tidx] = template.vecs
+        self.template_lower[tidx] = lower
+        self.template_upper[tidx] = upper
+        self.template_abs[tidx] = template.abs
+        self.template_bb[tidx] = template.bb
+        self.template_gids[tidx] = self.gnames.index(template.gname)
+
         self.templates += [template]
         self.samples += [sample]
+
+        for observer in self.observers:
+            observer.template_added(self, tidx)
         return self
 
+    def reserve(self, cnt: int, dimension: int) -> None:
+        """Grow the template store to hold at least cnt templates"""
+        if self.template_vecs is not None:
+            capacity = len(self.template_vecs)
+            if cnt <= capacity:
+                return
+            cnt = max(cnt, 2 * capacity)
+
+        used = len(self.templates)
+        shape = (cnt, self.resample_cnt - 1, dimension)
+
+        def grow(old, shape, dtype=float):
+            new = np.zeros(shape, dtype=dtype)
+            if old is not None:
+                new[:used] = old[:used]
+            return new
+
+        self.template_vecs = grow(self.template_vecs, shape)
+        self.template_lower = grow(self.template_lower, shape)
+        self.template_upper = grow(self.template_upper, shape)
+        self.template_abs = grow(self.template_abs, (cnt, dimension))
+        self.template_bb = grow(self.template_bb, (cnt, dimension))
+        self.template_gids = grow(self.template_gids, (cnt,), np.int64)
+
     def get_training_set(self) -> List[Sample]:
         return self.samples
 
@@ -98,36 +237,307 @@ class Jackknife(object):
         """Add Jackknife template based on Sample"""
         self.__iadd__(sample)
 
-    def classify(self, candidate: Sample) -> List[RecognitionResult]:
-        """Get list of matches sorted by best scores"""
-        c = Jackknife.Template(candidate, self.resample_cnt)
+    def classify(self,
+                 candidate: Sample,
+                 best_only: bool = False) -> List[RecognitionResult]:
+        """Get list of matches sorted by best scores
+
+        Templates are visited in order of a cheap lower bound on their
+        corrected score: an LB_Keogh style bound from each template's
+        envelope, then the sum of the band's row or column cost minima.
+        DTW is skipped for templates whose bound already reaches the
+        rejection threshold, and abandoned early for templates that cannot
+        score below it. With best_only, only the best match is returned,
+        so the best score so far is used as a bound as well. The returned
+        results are the same as without any pruning.
+        """
+        c, = Jackknife.Template.Cached([candidate], self.resample_cnt)
+        return self.classify_template(c, best_only)
+
+    def classify_many(self,
+                      candidates: List[Sample],
+                      best_only: bool = False) -> List[List[RecognitionResult]]:
+        """classify() of every candidate
+
+        Candidate templates are built in bulk, and candidates are scored
+        in groups: the lower bounds of every candidate and template pair
+        in a group are computed at once, and the pairs that survive them
+        are scored together in dtw_batch. With best_only, each candidate's
+        template with the lowest bound is scored first, and its score
+        bounds the candidate's other pairs.
+        """
+        cs = Jackknife.Template.Cached(candidates, self.resample_cnt)
+        cnt = len(self.templates)
+        if cnt == 0:
+            return [None] * len(cs)
+
         ret = []
+        group = max(1, Jackknife.pair_cnt // cnt)
+        for start in range(0, len(cs), group):
+            ret += self.classify_group(cs[start:start + group], best_only)
+        return ret
+
+    def classify_group(self,
+                       cs: List['Jackknife.Template'],
+                       best_only: bool = False) -> List[List[RecognitionResult]]:
+        """classify_many() of a group of candidate templates"""
+        cnt = len(self.templates)
+        threshold = self.rejection_threshold
+
+        cvecs = np.stack([c.vecs for c in cs])
+
+        # Correction factors and envelope bounds of every pair, as
+        # (candidates, templates) arrays. Dot products are taken one
+        # candidate at a time so they round as in classify.
+        abs_dot = np.stack([self.template_abs[:cnt] @ c.abs for c in cs])
+        bb_dot = np.stack([self.template_bb[:cnt] @ c.bb for c in cs])
+
+        cfs = np.ones((len(cs), cnt))
+        cfs *= 1.0 / np.fmax(0.01, abs_dot)
+        cfs *= 1.0 / np.fmax(0.01, bb_dot)
+
+        # The envelope bound of classify_template, with the larger of
+        # c * lower and c * upper taken per sign of c, so that every pair
+        # is bounded by two products of stacked arrays
+        row_bounds = 1.0 - np.einsum(
+            'kmd,tmd->ktm', np.maximum(cvecs, 0.0), self.template_upper[:cnt])
+        row_bounds -= np.einsum(
+            'kmd,tmd->ktm', np.minimum(cvecs, 0.0), self.template_lower[:cnt])
+        bounds = cfs * np.sum(np.maximum(row_bounds, 0.0), axis=2)
+        self.compared_cnt += bounds.size
+
+        cidxs = np.empty(0, dtype=np.int64)
+        tidxs = np.empty(0, dtype=np.int64)
+        scores = np.empty(0)
+        limits = np.full(len(cs), threshold)
+        todo = np.ones(bounds.shape, dtype=bool)
+
+        if best_only:
+            # The lowest bound's score bounds the rest of the candidate
+            cidxs = np.arange(len(cs))
+            tidxs = np.argmin(bounds, axis=1)
+            scores = self.score_pairs(cvecs, cfs, cidxs, tidxs, limits)
+            limits = np.fmin(limits, scores)
+            todo[cidxs, tidxs] = False
+
+        keep = todo & ~Jackknife.exceeds(bounds, limits[:, None])
+        self.pruned_cnt += np.count_nonzero(todo) - np.count_nonzero(keep)
+        more_cidxs, more_tidxs = np.nonzero(keep)
+        more_scores = self.score_pairs(cvecs, cfs, more_cidxs, more_tidxs,
+                                       limits[more_cidxs])
+
+        cidxs = np.concatenate((cidxs, more_cidxs))
+        tidxs = np.concatenate((tidxs, more_tidxs))
+        scores = np.concatenate((scores, more_scores))
+
+        ret = [[] for _ in cs]
+        for cidx, tidx, score in zip(cidxs, tidxs, scores):
+            if score < threshold:
+                ret[cidx] += [(tidx, score)]
+
+        for cidx, results in enumerate(ret):
+            if len(results) == 0:
+                ret[cidx] = None
+                continue
+            if best_only:
+                results = [min(results, key=lambda x: (x[1], x[0]))]
+
+            # Ties keep template order, as when templates are scored in
+            # order.
+            ret[cidx] = sorted(
+                RecognitionResult(score, self.templates[tidx])
+                for tidx, score in sorted(results, key=lambda x: x[0]))
+        return ret
+
+    def score_pairs(self,
+                    cvecs: np.ndarray,
+                    cfs: np.ndarray,
+                    cidxs: np.ndarray,
+                    tidxs: np.ndarray,
+                    limits: np.ndarray) -> np.ndarray:
+        """Corrected scores of candidate cidxs against template tidxs, pair
+        by pair; np.inf where a score must exceed its limit"""
+        # Pairs come grouped by candidate; each group is one matmul
+        n = cvecs.shape[1]
+        cost = np.empty((len(cidxs), n, n))
+        starts = np.flatnonzero(np.diff(cidxs, prepend=-1))
+        for start, end in zip(starts, np.append(starts[1:], len(cidxs))):
+            np.matmul(cvecs[cidxs[start]],
+                      self.template_vecs[tidxs[start:end]].transpose(0, 2, 1),
+                      out=cost[start:end])
+        np.subtract(1.0, cost, out=cost)
+
+        # Zero inside the Sakoe-Chiba band, inf outside of it
+        offsets = np.arange(n)
+        cost += np.where(
+            np.abs(offsets[:, None] - offsets[None, :]) > self.window,
+            np.inf,
+            0.0)
+
+        pair_cfs = cfs[cidxs, tidxs]
+        band_bounds = pair_cfs * np.maximum(
+            np.sum(np.min(cost, axis=2), axis=1),
+            np.sum(np.min(cost, axis=1), axis=1))
+
+        keep = ~Jackknife.exceeds(band_bounds, limits)
+        self.pruned_cnt += len(keep) - np.count_nonzero(keep)
+
+        scores = np.full(len(cidxs), np.inf)
+        scores[keep] = pair_cfs[keep] * self.dtw_batch(
+            cost[keep], self.window, limits[keep], pair_cfs[keep])
+        self.abandoned_cnt += np.count_nonzero(scores[keep] == np.inf)
+        return scores
+
+    def classify_template(self,
+                          c: 'Jackknife.Template',
+                          best_only: bool = False) -> List[RecognitionResult]:
+        """classify() of a candidate that is already a template"""
+        cnt = len(self.templates)
+        if cnt == 0:
+            return None
 
-        for t in self.templates:
+        cvecs = c.vecs
 
-            cf = 1.0
+        # Zero inside the Sakoe-Chiba band, inf outside of it
+        n = len(cvecs)
+        offsets = np.arange(n)
+        outside = np.where(
+            np.abs(offsets[:, None] - offsets[None, :]) > self.window,
+            np.inf,
+            0.0)
 
-            abs_dot = np.dot(c.abs, t.abs)
-            bb_dot = np.dot(c.bb, t.bb)
+        #
+        # Correction factors and envelope bounds for every template
+        #
+        cfs = np.ones(cnt)
 
-            cf *= 1.0 / max(0.01, abs_dot)
-            cf *= 1.0 / max(0.01, bb_dot)
+        abs_dot = self.template_abs[:cnt] @ c.abs
+        bb_dot = self.template_bb[:cnt] @ c.bb
 
-            score = cf
+        cfs *= 1.0 / np.fmax(0.01, abs_dot)
+        cfs *= 1.0 / np.fmax(0.01, bb_dot)
 
-            score *= self.dtw_vec(
-                c.vecs,
-                t.vecs,
-                self.window)
+        row_bounds = 1.0 - np.sum(
+            np.maximum(cvecs * self.template_lower[:cnt],
+                       cvecs * self.template_upper[:cnt]), axis=2)
+        bounds = cfs * np.sum(np.maximum(row_bounds, 0.0), axis=1)
 
-            if score < self.rejection_threshold:
-                r = RecognitionResult(score, t)
-                ret += [r]
+        ret = []
+        best = np.inf
+        best_tidx = -1
+        order = np.argsort(bounds, kind='stable')
+        self.compared_cnt += cnt
+
+        # Score all templates in one batch, or, when only the best match
+        # is needed, in chunks so that each chunk is bounded by the best
+        # score of the chunks before it.
+        chunk = Jackknife.chunk_size if best_only else cnt
+
+        for start in range(0, cnt, chunk):
+
+            bound = self.rejection_threshold
+            if best_only:
+                bound = min(bound, best)
+
+            # Bounds are sorted, so once one is too large, no remaining
+            # template can do better.
+            tidxs = order[start:start + chunk]
+            keep = ~Jackknife.exceeds(bounds[tidxs], bound)
+            done = not keep.all()
+            if done:
+                self.pruned_cnt += cnt - start - np.count_nonzero(keep)
+                tidxs = tidxs[keep]
+
+            cost = np.matmul(
+                cvecs,
+                self.template_vecs[tidxs].transpose(0, 2, 1))
+            np.subtract(1.0, cost, out=cost)
+            cost += outside
+            band_bounds = cfs[tidxs] * np.maximum(
+                np.sum(np.min(cost, axis=2), axis=1),
+                np.sum(np.min(cost, axis=1), axis=1))
+
+            keep = ~Jackknife.exceeds(band_bounds, bound)
+            self.pruned_cnt += len(keep) - np.count_nonzero(keep)
+            tidxs = tidxs[keep]
+            cost = cost[keep]
+
+            scores = cfs[tidxs]
+            scores *= self.dtw_batch(
+                cost,
+                self.window,
+                bound,
+                cfs[tidxs])
+
+            self.abandoned_cnt += np.count_nonzero(scores == np.inf)
+
+            for tidx, score in zip(tidxs, scores):
+                if score < self.rejection_threshold:
+                    if best_only:
+                        if (score, tidx) >= (best, best_tidx):
+                            continue
+                        best = score
+                        best_tidx = tidx
+                        ret = []
+                    r = RecognitionResult(score, self.templates[tidx])
+                    ret += [(tidx, r)]
+
+            if done:
+                break
 
         if len(ret) == 0:
             return None
 
-        return sorted(ret)
+        # Ties keep template order, as when templates are scored in order.
+        return sorted(r for tidx, r in sorted(ret, key=lambda x: x[0]))
+
+    def score_template(self,
+                       c: 'Jackknife.Template',
+                       tidxs: np.ndarray = None) -> np.ndarray:
+        """Corrected scores of a candidate template against templates tidxs
+        (all by default), with no pruning or rejection.
+
+        Scores are those classify would report for the same templates.
+        """
+        if tidxs is None:
+            tidxs = np.arange(len(self.templates))
+        tidxs = np.asarray(tidxs, dtype=np.int64)
+
+        cfs = np.ones(len(tidxs))
+        cfs *= 1.0 / np.fmax(0.01, self.template_abs[tidxs] @ c.abs)
+        cfs *= 1.0 / np.fmax(0.01, self.template_bb[tidxs] @ c.bb)
+
+        cost = np.matmul(
+            c.vecs,
+            self.template_vecs[tidxs].transpose(0, 2, 1))
+        np.subtract(1.0, cost, out=cost)
+
+        cfs *= self.dtw_batch(cost, self.window)
+        return cfs
+
+    @staticmethod
+    def exceeds(lower_bound: float, bound: float) -> bool:
+        """True if a score with this lower bound must be above bound.
+
+        Leaves a small margin for rounding in the bound computations.
+        """
+        return lower_bound * (1.0 - 1e-9) > bound
+
+    # Templates scored per batch when classify only needs the best match
+    chunk_size = 32
+
+    # Candidate and template pairs bounded together by classify_many
+    pair_cnt = 1 << 10
+
+    # Templates shared by all recognizers, so that samples seen again in
+    # another fold or iteration are not resampled again
+    template_cache = None
+
+    def pruning_rate(self) -> float:
+        """Fraction of template comparisons in classify that skipped DTW"""
+        if self.compared_cnt == 0:
+            return 0.0
+        return self.pruned_cnt / self.compared_cnt
 
     def measure(self, candidate_pts: Union[list, np.ndarray], tidx: int) -> float:
         """Return score against points"""
@@ -138,39 +548,199 @@ class Jackknife(object):
         window = int(round(len(candidate_pts) * .1))
 
         score = Jackknife.dtw_vec(c_vecs,
-                                  self.templates[tidx].vecs,
+                                  self.template_vecs[tidx],
                                   window)
 
         return score
 
+    def measure_many(self,
+                     candidates: Union[List, np.ndarray],
+                     tidx: Union[int, np.ndarray]) -> np.ndarray:
+        """measure() of many candidates at once
+
+        candidates is a (k, m, d) array or a list of point arrays, and
+        tidx one template index or one per candidate. Candidates are
+        resampled, vectorized and scored in bulk.
+        """
+        cnt = len(candidates)
+        tidxs = np.broadcast_to(tidx, (cnt,))
+
+        # Resample equal length candidates together
+        pts = np.empty((cnt, self.resample_cnt, self.template_vecs.shape[-1]))
+        if isinstance(candidates, np.ndarray):
+            pts[:] = uniform_resample_many(candidates, self.resample_cnt)
+        else:
+            groups = {}
+            for idx, candidate in enumerate(candidates):
+                groups.setdefault(np.shape(candidate), []).append(idx)
+            for idxs in groups.values():
+                pts[idxs] = uniform_resample_many(
+                    [candidates[idx] for idx in idxs], self.resample_cnt)
+
+        c_vecs = Jackknife.Template.vectorize(pts)
+
+        window = int(round(self.resample_cnt * .1))
+
+        cost = np.matmul(
+            c_vecs,
+            self.template_vecs[tidxs].transpose(0, 2, 1))
+        np.subtract(1.0, cost, out=cost)
+
+        return Jackknife.dtw_batch(cost, window)
+
     @staticmethod
     def dtw_vec(cvecs: Union[list, np.ndarray],
                 tvecs: Union[list, np.ndarray],
-                window: int) -> float:
-        """Calculate warping distance"""
+                window: int,
+                bound: float = np.inf,
+                cf: float = 1.0) -> float:
+        """Calculate warping distance
+
+        Every warping path crosses each row of the band and costs are
+        non-negative, so once cf times the smallest value in a row exceeds
+        bound, the corrected score will too; np.inf is returned early.
+
+        The cosine cost of every cell comes from one matrix product, and
+        the Sakoe-Chiba band is filled one row at a time. Insert and match
+        read the previous row; the delete chain within a row,
+        D[j] = min(a[j], D[j - 1] + cost[j]), is solved as
+        D = C + cummin(a - C) with C the running sum of the row's costs.
+        That reorders a few additions, so scores agree with the cell by
+        cell recurrence to within ~1e-12.
+        """
 
+        cvecs = np.asarray(cvecs)
+        tvecs = np.asarray(tvecs)
         assert (len(cvecs) == len(tvecs))
-        n = len(cvecs)
 
-        dtw = np.full((n + 1, n + 1), np.inf)
-        dtw[0, 0] = 0.0
+        cost = 1.0 - cvecs @ tvecs.T
 
-        for ii in range(1, n + 1):
-            minimum = max(1, ii - window)
-            maximum = min(ii + window, n)
+        return Jackknife.dtw_cost(cost, window, bound, cf)
 
-            for jj in range(minimum, maximum + 1):
-                cost = 1 - np.dot(
-                    cvecs[(ii - 1)],
-                    tvecs[(jj - 1)])
+    @staticmethod
+    def dtw_cost(cost: np.ndarray,
+                 window: int,
+                 bound: float = np.inf,
+                 cf: float = 1.0) -> float:
+        """dtw_vec over a precomputed (n, n) cost matrix"""
+        return Jackknife.dtw_batch(cost[np.newaxis], window, bound, cf)[0]
 
-                insert = dtw[ii - 1, jj]
-                delete = dtw[ii, jj - 1]
-                match = dtw[ii - 1, jj - 1]
+    @staticmethod
+    def dtw_batch(cost: np.ndarray,
+                  window: int,
+                  bounds: Union[float, np.ndarray] = np.inf,
+                  cfs: Union[float, np.ndarray] = 1.0) -> np.ndarray:
+        """dtw_cost for a (B, n, n) stack of cost matrices at once
+
+        Every matrix advances one band row per step. bounds and cfs are
+        scalars or (B,) arrays; a matrix whose scaled row minimum exceeds
+        its bound is dropped from the remaining steps and scores np.inf.
+        """
 
-                dtw[ii, jj] = min(insert, delete, match) + cost
+        cnt, n = cost.shape[0], cost.shape[1]
+        bounds = np.broadcast_to(bounds, (cnt,))
+        cfs = np.broadcast_to(cfs, (cnt,))
 
-        return dtw[n, n]
+        active = np.arange(cnt)
+        check = bool(np.any(bounds < np.inf))
+
+        # One band row per matrix, updated in place. Cells right of the
+        # band are still inf, and the one left of it is reset each step.
+        dtw = np.full((cnt, n + 1), np.inf)
+        dtw[:, 0] = 0.0
+
+        for ii in range(1, n + 1):
+            minimum = max(1, ii - window)
+            maximum = min(ii + window, n)
+
+            if len(active) == cnt:
+                row_cost = cost[:, ii - 1, minimum - 1:maximum]
+            else:
+                row_cost = cost[active, ii - 1, minimum - 1:maximum]
+
+            insert_match = np.minimum(
+                dtw[:, minimum:maximum + 1],
+                dtw[:, minimum - 1:maximum])
+            insert_match += row_cost
+
+            csum = np.add.accumulate(row_cost, axis=1)
+            insert_match -= csum
+            row = dtw[:, minimum:maximum + 1]
+            np.minimum.accumulate(insert_match, axis=1, out=row)
+            row += csum
+            dtw[:, minimum - 1] = np.inf
+
+            if check:
+                alive = ~(cfs[active] * np.min(row, axis=1) > bounds[active])
+                if not alive.all():
+                    active = active[alive]
+                    dtw = dtw[alive]
+
+        ret = np.full(cnt, np.inf)
+        ret[active] = dtw[:, n]
+        return ret
 
     def set_rejection_threshold(self, r: float):
         self.rejection_threshold = r
+
+
+class TemplateCache(object):
+    """Byte-bounded LRU of templates, keyed by sample identity and
+    resample count.
+
+    Entries hold on to their sample, so an id is never reused while its
+    template is cached. Samples are assumed not to change after they are
+    first used, so clear() the cache if a trajectory is replaced.
+
+    Templates are measured by Template.nbytes when they are put and again
+    whenever they are used, so envelopes built in between are counted.
+    Once the templates exceed max_bytes, the least recently used ones are
+    evicted; the most recent one is always kept.
+    """
+
+    def __init__(self, max_bytes: int):
+        """ """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hit_cnt = 0
+        self.miss_cnt = 0
+
+    def clear(self):
+        """ """
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, sample: Sample, n: int) -> Jackknife.Template:
+        """Cached template of sample, or None"""
+        key = (id(sample), n)
+        entry = self.entries.get(key)
+        if entry is None or entry[0].sample is not sample:
+            self.miss_cnt += 1
+            return None
+        self.hit_cnt += 1
+        template, nbytes = entry
+        self.store(key, template, nbytes)
+        return template
+
+    def put(self, template: Jackknife.Template, n: int) -> None:
+        """ """
+        if self.max_bytes <= 0:
+            return
+        key = (id(template.sample), n)
+        entry = self.entries.get(key)
+        self.store(key, template, 0 if entry is None else entry[1])
+
+    def store(self, key, template: Jackknife.Template, old_nbytes: int):
+        """Make template the most recent entry, measure it, evict"""
+        nbytes = template.nbytes
+        self.entries[key] = (template, nbytes)
+        self.entries.move_to_end(key)
+        self.nbytes += nbytes - old_nbytes
+
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, old_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= old_nbytes
+
+
+Jackknife.template_cache = TemplateCache(64 << 20)
@@ -16,70 +16,188 @@
 # is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
 
 
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import os
 
 from dataset import Dataset
 from jackknife import Jackknife
+from score_matrix import ScoreMatrix
 from download_ha import dowload_ha
 from stats import ConfusionMatrix
 import synthetic
 import tables
+import utils
 from tables import DeviceType
 from numpy import mean
 
 
-def run_recognizer(dataset: Dataset,
-                   train_count: int,
-                   iteration_count: int):
-    """Run recognizer with specified parameters"""
+def run_fold(dataset: Dataset,
+             train: list,
+             test: list,
+             train_count: int,
+             score_matrix: ScoreMatrix = None):
+    """Train on one fold and classify its test samples
 
-    ds_iterator = dataset.ud(train_count, iteration_count)
+    Returns a ConfusionMatrix of the fold, its correct and total counts,
+    the scores of correct matches, and the template comparisons made and
+    pruned.
+    """
     resample_count = tables.get_device_resample_count(dataset.device_type)
     cfm = ConfusionMatrix(dataset.gnames)
     scores = []
-
     correct, total = 0, 0
-    for idx, (train, test) in enumerate(ds_iterator):
-        print(
-            f"Iteration: {idx + 1} / {iteration_count * len(dataset.snames)}")
 
-        # Create recognizer
-        recognizer = Jackknife(resample_cnt=resample_count,
-                               device_type=dataset.device_type)
+    # Create recognizer
+    recognizer = Jackknife(resample_cnt=resample_count,
+                           device_type=dataset.device_type)
+
+    # Train recognizer
+    for t in train:
+        recognizer.add_template(t)
+
+    # Determine and set the rejection threshold
+    thresh = synthetic.select_rejection_threshold(
+        recognizer,
+        dataset.device_type,
+        beta=1,
+        train_cnt=train_count,
+    )
+
+    recognizer.set_rejection_threshold(thresh)
+
+    if score_matrix is not None:
+        test_results = score_matrix.classify(train, test, thresh)
+    else:
+        test_results = recognizer.classify_many(test, best_only=True)
+
+    expected_ids = []
+    classified_ids = []
+    for t, results in zip(test, test_results):
+        classified_gname = None
+        if results is not None:
+            classified_gname = results[0].gname
+
+        expected_ids += [cfm.gids[t.gname]]
+        classified_ids += [cfm.gids.get(classified_gname, -1)]
+
+        correct += float(t.gname == classified_gname)
+        if t.gname == classified_gname:
+            scores += [results[0].score]
+
+        total += 1.0
+
+    cfm.update_many(expected_ids, classified_ids)
+
+    return (cfm, correct, total, scores,
+            recognizer.compared_cnt, recognizer.pruned_cnt)
 
-        # Train recognizer
-        for t in train:
-            recognizer.add_template(t)
 
-        # Determine and set the rejection threshold
-        thresh = synthetic.select_rejection_threshold(
-            recognizer,
-            device_type,
-            beta=1,
-            train_cnt=train_count,
-        )
+# Dataset and score matrix of a worker process, see init_worker
+worker_state = {}
 
-        recognizer.set_rejection_threshold(thresh)
 
-        for t in test:
-            results = recognizer.classify(t)
+def init_worker(dataset: Dataset, score_matrix: ScoreMatrix = None):
+    """Receive the dataset once per worker process"""
+    worker_state["dataset"] = dataset
+    worker_state["score_matrix"] = score_matrix
 
-            classified_gname = None
-            if results is not None:
-                classified_gname = results[0].gname
 
-            cfm.update(t.gname, classified_gname)
+def run_task(task):
+    """Run one fold given by sample indices, seeding it first"""
+    idx, fold_cnt, fold_seed, train, test, train_count = task
+    dataset = worker_state["dataset"]
 
-            correct += float(t.gname == classified_gname)
-            if t.gname == classified_gname:
-                scores += [results[0].score]
+    print(f"Iteration: {idx + 1} / {fold_cnt}")
+    utils.seed(fold_seed)
 
-            total += 1.0
+    ret = run_fold(dataset,
+                   [dataset.samples[sidx] for sidx in train],
+                   [dataset.samples[sidx] for sidx in test],
+                   train_count,
+                   worker_state["score_matrix"])
+    print()
+    return ret
 
-        print()
+
+def fold_seeds(seed: int, fold_cnt: int) -> list:
+    """One seed per fold, derived from seed.
+
+    Without a seed, fresh entropy is drawn, so forked workers, which start
+    from a copy of the parent's generator, still draw differently.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    return [int(np.random.SeedSequence([seed, idx]).generate_state(1)[0])
+            for idx in range(fold_cnt)]
+
+
+def run_recognizer(dataset: Dataset,
+                   train_count: int,
+                   iteration_count: int,
+                   score_matrix: ScoreMatrix = None,
+                   workers: int = 1,
+                   seed: int = None):
+    """Run recognizer with specified parameters
+
+    With a precomputed (ud) score_matrix, test samples are classified by
+    looking up their scores instead of running DTW; the rejection
+    threshold is still selected per fold. Worker processes memory map a
+    saved score matrix from its path rather than receiving a copy.
+
+    With workers > 1, folds are run in a process pool. Folds are drawn up
+    front and every fold is seeded on its own, see fold_seeds. With a
+    seed, results do not depend on the number of workers.
+    """
+
+    if score_matrix is not None and score_matrix.mode != 'ud':
+        raise ValueError("Folds are user dependent, but the score matrix "
+                         "is {}".format(score_matrix.mode))
+
+    if seed is not None:
+        utils.seed(seed)
+
+    index = {id(s): sidx for sidx, s in enumerate(dataset.samples)}
+    folds = list(dataset.ud(train_count, iteration_count))
+
+    tasks = []
+    for idx, ((train, test), fold_seed) in enumerate(
+            zip(folds, fold_seeds(seed, len(folds)))):
+        tasks += [(idx,
+                   len(folds),
+                   fold_seed,
+                   [index[id(t)] for t in train],
+                   [index[id(t)] for t in test],
+                   train_count)]
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=init_worker,
+                                       initargs=(dataset, score_matrix))
+    else:
+        init_worker(dataset, score_matrix)
+        executor = Dataset.Executor(1)
+
+    cfm = ConfusionMatrix(dataset.gnames)
+    scores = []
+
+    correct, total = 0, 0
+    compared, pruned = 0, 0
+    with executor:
+        for ret in executor.map(run_task, tasks):
+            fold_cfm, fold_correct, fold_total, fold_scores, \
+                fold_compared, fold_pruned = ret
+            cfm.merge(fold_cfm)
+            correct += fold_correct
+            total += fold_total
+            scores += fold_scores
+            compared += fold_compared
+            pruned += fold_pruned
 
     print("accuracy: {:2.2f}".format(float(correct / total)))
     print("F score:", cfm.fscore())
+    print("pruned by lower bound: {:2.2f}%".format(
+        100.0 * pruned / max(compared, 1)))
     # print("avg winning score: ", mean(scores))
 
     return float(correct / total), cfm.fscore()
@@ -89,6 +207,7 @@ if __name__ == '__main__':
     """ """
     device_type = DeviceType.KINECT
     use_filter = True
+    use_score_matrix = False
     device_path = tables.get_device_dataset_path(device_type)
 
     if not os.path.isdir(device_path):
@@ -97,11 +216,24 @@ if __name__ == '__main__':
 
     ds = Dataset.Load(device_path,
                       device_type,
-                      filter=use_filter
+                      filter=use_filter,
+                      cache=True
                       )
 
     # print(ds)
 
+    score_matrix = None
+    if use_score_matrix:
+        score_matrix = ScoreMatrix.Load(
+            ds,
+            tables.get_device_resample_count(device_type),
+            mode='ud',
+            path=os.path.join(
+                Dataset.CachePath(device_path, filter=use_filter), "ud"),
+            workers=os.cpu_count() or 1)
+
     run_recognizer(dataset=ds,
                    train_count=1,
-                   iteration_count=1)
+                   iteration_count=1,
+                   score_matrix=score_matrix,
+                   workers=os.cpu_count() or 1)
@@ -21,7 +21,10 @@ from jackknife import Jackknife
 import utils
 from tables import DeviceType
 
+from collections import OrderedDict
+import hashlib
 import numpy as np
+import os
 import random
 
 
@@ -29,26 +32,78 @@ class Mincer:
     def __init__(self, recognizer: Jackknife):
         self.device_type: DeviceType = recognizer.device_type
         self.training_samples = recognizer.get_training_set()
-        self.prepared_trajectories = [
-            Mincer.prepare_trajectory(t) for t in self.training_samples]
+
+        # Prepared vectors as one (N, n, d) array, each sample's gesture
+        # as an index (of its gesture's first sample), and every
+        # (idx1, idx2) pair that mince accepts. prepared and gids are
+        # views of stores with spare rows, see update.
+        self.store = Mincer.prepared_cache.get_many(self.training_samples)
+        self.gid_store = np.empty(len(self.store), dtype=np.int64)
+        self.first = {}
+        for idx, sample in enumerate(self.training_samples):
+            self.gid_store[idx] = self.first.setdefault(sample.gname, idx)
+        self.prepared = self.store
+        self.prepared_trajectories = self.prepared
+        self.gids = self.gid_store
+        self.splices = Mincer.Splices(self.store)
+
+    def update(self):
+        """Add the samples the recognizer was given since, appending to
+        the stores rather than preparing every sample again"""
+        cnt = len(self.gids)
+        samples = self.training_samples[cnt:]
+        if len(samples) == 0:
+            return
+
+        prepared = Mincer.prepared_cache.get_many(samples)
+        new_cnt = cnt + len(samples)
+        if cnt == 0 or new_cnt > len(self.store):
+            store = np.empty((max(16, 2 * new_cnt),) + prepared.shape[1:])
+            if cnt > 0:
+                store[:cnt] = self.store[:cnt]
+            self.store = store
+            gid_store = np.empty(len(store), dtype=np.int64)
+            gid_store[:cnt] = self.gid_store[:cnt]
+            self.gid_store = gid_store
+
+        self.store[cnt:new_cnt] = prepared
+        for idx, sample in enumerate(samples, cnt):
+            self.gid_store[idx] = self.first.setdefault(sample.gname, idx)
+
+        self.prepared = self.store[:new_cnt]
+        self.prepared_trajectories = self.prepared
+        self.gids = self.gid_store[:new_cnt]
+        if cnt == 0:
+            self.splices = Mincer.Splices(self.prepared)
 
     @staticmethod
-    def prepare_trajectory(sample: Sample):
+    def Splices(prepared: np.ndarray) -> np.ndarray:
+        """Every (idx1, idx2) pair that mince accepts"""
+        n = prepared.shape[1] if prepared.ndim == 3 else 0
+        idx1, idx2 = np.divmod(np.arange(n * n), n)
+        valid = np.abs(idx2 - idx1) + 1 >= n / 3
+        return np.stack((idx1[valid], idx2[valid]), axis=1)
+
+    # Prepared trajectories shared by all mincers, see PreparedCache
+    prepared_cache = None
+
+    # Points each trajectory is resampled to before differencing
+    resample_cnt = 128
+
+    @staticmethod
+    def prepare_trajectory(sample: Sample) -> np.ndarray:
         """"""
-        prepared = utils.uniform_resample(sample.trajectory, n=128)
+        prepared = utils.uniform_resample(sample.trajectory,
+                                          n=Mincer.resample_cnt)
 
         # move origin to centroid and scale longer side to 1
         centroid = np.mean(prepared, axis=0)
         width = np.max(prepared, axis=0) - np.min(prepared, axis=0)
         scale = np.amax(width)
-        for pt in prepared:
-            pt -= centroid
-            pt /= scale
+        prepared -= centroid
+        prepared /= scale
 
-        vecs = []
-        for i in range(1, len(prepared)):
-            vecs += [prepared[i] - prepared[i - 1]]
-        return vecs
+        return np.diff(prepared, axis=0)
 
     def mince(self, target_idx: int):
         """"""
@@ -102,3 +157,221 @@ class Mincer:
             minced_sample += [pt]
 
         return minced_sample
+
+    def mince_batch(self,
+                    target_idx: int,
+                    k: int,
+                    rng: np.random.Generator = None) -> np.ndarray:
+        """k mince(target_idx) negatives at once, as a (k, n + 1, d) array
+
+        Draws come from rng (utils.rng by default): the other sample
+        uniformly among those of a different gesture, and (idx1, idx2)
+        uniformly among the pairs mince accepts, as its rejection
+        sampling does. The middle segment runs from idx1 to idx2, so it
+        is reversed when idx1 > idx2.
+        """
+        if rng is None:
+            rng = utils.rng
+
+        others = np.flatnonzero(self.gids != self.gids[target_idx])
+        if len(others) == 0:
+            raise ValueError(
+                "No training sample of another gesture to mince with")
+
+        other_idx = others[rng.integers(0, len(others), size=k)]
+        idx1, idx2 = self.splices[
+            rng.integers(0, len(self.splices), size=k)].T
+
+        # Source sample and vector of every output vector
+        _, n, m = self.prepared.shape
+        j = np.arange(n)
+        lo = np.minimum(idx1, idx2)[:, None]
+        hi = np.maximum(idx1, idx2)[:, None]
+        middle = (lo <= j) & (j <= hi)
+        step = np.where(idx1 <= idx2, 1, -1)[:, None]
+
+        sources = np.where(middle, other_idx[:, None], target_idx)
+        vidxs = np.where(middle, idx1[:, None] + step * (j - lo), j)
+
+        minced = np.zeros((k, n + 1, m))
+        np.cumsum(self.prepared[sources, vidxs], axis=1, out=minced[:, 1:])
+        return minced
+
+
+class PreparedCache(object):
+    """Process-wide, byte-bounded LRU of prepared trajectories.
+
+    Rows of one compact (capacity, n, d) array per dimension d, looked up
+    by sample identity; entries hold on to their sample, so an id is never
+    reused while it is cached. Once the rows held exceed max_bytes, the
+    least recently used ones are dropped along with their samples, and
+    their space is reused. Arrays only grow past max_bytes to hold the
+    rows of a single get_many call, and are compacted back afterwards.
+    With a path, rows are also found by a hash of the sample's
+    trajectory, and save() writes them there for later processes.
+    """
+
+    def __init__(self, path: str = None, max_bytes: int = 32 << 20):
+        """ """
+        self.max_bytes = max_bytes
+        self.path = path
+        self.rows = {}
+        self.digests = {}
+        self.stores = {}
+        self.nbytes = 0
+
+        # (d, row) -> (digest, ids of the samples using it), least
+        # recently used first, and rows free for reuse per d
+        self.slots = OrderedDict()
+        self.free = {}
+
+        if path is not None:
+            self.load()
+
+    def clear(self):
+        """ """
+        self.rows.clear()
+        self.digests.clear()
+        self.stores.clear()
+        self.slots.clear()
+        self.free.clear()
+        self.nbytes = 0
+
+    @staticmethod
+    def Digest(sample: Sample) -> str:
+        """Content hash of a sample's trajectory"""
+        trajectory = np.ascontiguousarray(sample.trajectory, dtype=float)
+        digest = hashlib.sha1(str(trajectory.shape).encode())
+        digest.update(trajectory.tobytes())
+        return digest.hexdigest()
+
+    def append(self, prepared: np.ndarray, digest: str = None) -> tuple:
+        """Store prepared in a free row, growing its array as needed;
+        returns the row"""
+        d = prepared.shape[-1]
+        store, cnt = self.stores.get(d, (None, 0))
+        free = self.free.get(d)
+        if free:
+            row = free.pop()
+        else:
+            if store is None or cnt == len(store):
+                capacity = min(max(16, 2 * cnt), self.capacity(prepared))
+                grown = np.empty((max(capacity, cnt + 1),) + prepared.shape)
+                if store is not None:
+                    grown[:cnt] = store[:cnt]
+                store = grown
+            row = cnt
+            cnt += 1
+        store[row] = prepared
+        self.stores[d] = (store, cnt)
+        self.nbytes += prepared.nbytes
+
+        self.slots[(d, row)] = (digest, [])
+        if digest is not None:
+            self.digests[digest] = (d, row)
+        return d, row
+
+    def capacity(self, prepared: np.ndarray) -> int:
+        """Rows like prepared that fit in max_bytes"""
+        return max(1, self.max_bytes // max(prepared.nbytes, 1))
+
+    def evict(self) -> None:
+        """Drop least recently used rows until at most max_bytes are held,
+        then compact arrays that grew past it"""
+        while self.nbytes > self.max_bytes and self.slots:
+            (d, row), (digest, ids) = self.slots.popitem(last=False)
+            if digest is not None:
+                del self.digests[digest]
+            for key in ids:
+                del self.rows[key]
+            self.free.setdefault(d, []).append(row)
+            self.nbytes -= self.stores[d][0][row].nbytes
+
+        for d, (store, _) in list(self.stores.items()):
+            if len(store) > self.capacity(store[0]):
+                self.compact(d)
+
+    def compact(self, d: int) -> None:
+        """Move the rows held for d into an array of just their size"""
+        store, _ = self.stores[d]
+        live = [row for dd, row in self.slots if dd == d]
+        moved = {row: idx for idx, row in enumerate(live)}
+
+        slots = OrderedDict()
+        for (dd, row), (digest, ids) in self.slots.items():
+            if dd == d:
+                row = moved[row]
+                if digest is not None:
+                    self.digests[digest] = (d, row)
+                for key in ids:
+                    self.rows[key] = (self.rows[key][0], (d, row))
+            slots[(dd, row)] = (digest, ids)
+
+        self.slots = slots
+        self.free[d] = []
+        self.stores[d] = (store[live], len(live))
+
+    def get_many(self, samples) -> np.ndarray:
+        """(N, n, d) prepared trajectories of samples"""
+        rows = []
+        for sample in samples:
+            entry = self.rows.get(id(sample))
+            if entry is None or entry[0] is not sample:
+                digest = None
+                row = None
+                if self.path is not None:
+                    digest = PreparedCache.Digest(sample)
+                    row = self.digests.get(digest)
+                if row is None:
+                    row = self.append(Mincer.prepare_trajectory(sample),
+                                      digest)
+                entry = (sample, row)
+                self.rows[id(sample)] = entry
+                self.slots[row][1].append(id(sample))
+            self.slots.move_to_end(entry[1])
+            rows += [entry[1]]
+
+        if len(rows) == 0:
+            return np.empty((0, Mincer.resample_cnt - 1, 0))
+
+        d = rows[0][0]
+        store, _ = self.stores[d]
+        ret = store[[row for _, row in rows]]
+
+        # Only after gathering, so rows of this call are never reused
+        # before they are read
+        self.evict()
+        return ret
+
+    def load(self):
+        """Read the rows saved under path, if any"""
+        fname = os.path.join(self.path, "prepared.npz")
+        if not os.path.exists(fname):
+            return
+        with np.load(fname) as saved:
+            for key in saved.files:
+                if not key.startswith("prepared"):
+                    continue
+                prepared = saved[key]
+                digests = saved["digests" + key[len("prepared"):]]
+                for digest, row in zip(digests.tolist(), prepared):
+                    self.append(row, digest)
+        self.evict()
+
+    def save(self):
+        """Write all rows with a known digest to path"""
+        arrays = {}
+        for d, (store, cnt) in self.stores.items():
+            hashed = [(digest, row) for digest, (dd, row)
+                      in self.digests.items() if dd == d]
+            arrays["prepared{}".format(d)] = store[[r for _, r in hashed]]
+            arrays["digests{}".format(d)] = np.array(
+                [digest for digest, _ in hashed], dtype=np.str_)
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, "prepared.tmp.npz")
+        np.savez(tmp, **arrays)
+        os.replace(tmp, os.path.join(self.path, "prepared.npz"))
+
+
+Mincer.prepared_cache = PreparedCache()
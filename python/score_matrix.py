@@ -0,0 +1,253 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+from typing import List
+import hashlib
+import numpy as np
+import os
+
+from dataset import Dataset, Sample
+from jackknife import Jackknife
+from stats import RecognitionResult
+
+
+class ScoreMatrix(object):
+    """Corrected DTW scores between pairs of samples in a dataset.
+
+    The score of dataset.samples[i] as the candidate against
+    dataset.samples[j] as a template is the one classify reports. With
+    mode 'ud' only pairs of the same subject are computed, with 'ui' only
+    pairs of different subjects. Scores are stored row by row in a
+    compressed sparse row layout: the template ids of row i are
+    indices[indptr[i]:indptr[i + 1]], in increasing order, and scores
+    holds their scores at the same positions. Once computed, each
+    evaluation fold is answered by indexing instead of running DTW.
+    """
+
+    # Templates scored per task when computing the matrix
+    chunk_size = 256
+
+    def __init__(self,
+                 dataset: Dataset,
+                 resample_cnt: int,
+                 mode: str = 'ud',
+                 window: float = .1):
+        """ """
+        if mode not in ('ud', 'ui'):
+            raise ValueError("Unknown mode {}".format(mode))
+
+        self.dataset = dataset
+        self.resample_cnt = resample_cnt
+        self.mode = mode
+        self.window = window
+        self.index = {id(s): idx for idx, s in enumerate(dataset.samples)}
+        snames = {sname: sid for sid, sname in enumerate(dataset.snames)}
+        self.sids = np.array([snames[s.sname] for s in dataset.samples],
+                             dtype=np.int64)
+
+        # Row layout, see class doc
+        self.indptr = None
+        self.indices = None
+        self.scores = None
+
+        # Directory the scores were saved to or loaded from, if any, and
+        # the stamp they were saved with
+        self.path = None
+        self.path_stamp = None
+
+    def __getstate__(self):
+        """Scores saved to disk are not pickled, so worker processes memory
+        map the same files instead of each holding a copy"""
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state["indptr"] = None
+            state["indices"] = None
+            state["scores"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Samples are new objects after unpickling; index them again"""
+        self.__dict__.update(state)
+        self.index = {
+            id(s): idx for idx, s in enumerate(self.dataset.samples)}
+        if self.path is not None and not self.load(self.path,
+                                                   self.path_stamp):
+            raise ValueError(
+                "Scores in {} are missing or stale".format(self.path))
+
+    @classmethod
+    def Load(cls,
+             dataset: Dataset,
+             resample_cnt: int,
+             mode: str = 'ud',
+             window: float = .1,
+             path: str = None,
+             workers: int = 1) -> 'ScoreMatrix':
+        """Score matrix of dataset, read from path if it is up to date.
+
+        Otherwise it is computed, in parallel with workers > 1, and saved
+        to path if one is given.
+        """
+        ret = cls(dataset, resample_cnt, mode, window)
+
+        if path is not None:
+            stamp = ret.stamp()
+            if ret.load(path, stamp):
+                return ret
+
+        ret.compute(workers)
+
+        if path is not None:
+            ret.save(path, stamp)
+        return ret
+
+    def stamp(self) -> str:
+        """Digest of the sample trajectories and the scoring parameters"""
+        digest = hashlib.sha1()
+        digest.update("csr\0{}\0{}\0{}\n".format(
+            self.mode,
+            self.resample_cnt,
+            int(round(self.resample_cnt * self.window))).encode())
+        for sample in self.dataset.samples:
+            trajectory = np.ascontiguousarray(sample.trajectory, dtype=float)
+            digest.update("{}\0{}\n".format(
+                sample.sname, trajectory.shape).encode())
+            digest.update(trajectory.tobytes())
+        return digest.hexdigest()
+
+    def save(self, path: str, stamp: str) -> None:
+        """Write the scores and their stamp to the directory path"""
+        os.makedirs(path, exist_ok=True)
+
+        # Invalidate first so a partial write is never picked up.
+        stamp_path = os.path.join(path, "stamp")
+        if os.path.exists(stamp_path):
+            os.remove(stamp_path)
+
+        np.save(os.path.join(path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(path, "indices.npy"), self.indices)
+        np.save(os.path.join(path, "scores.npy"), self.scores)
+
+        with open(stamp_path, "w") as fout:
+            fout.write(stamp)
+
+        self.path = path
+        self.path_stamp = stamp
+
+    def load(self, path: str, stamp: str) -> bool:
+        """Memory map saved scores; False if they are missing or stale"""
+        stamp_path = os.path.join(path, "stamp")
+        if not os.path.exists(stamp_path):
+            return False
+
+        with open(stamp_path, "r") as fin:
+            if fin.read() != stamp:
+                return False
+
+        self.indptr = np.load(os.path.join(path, "indptr.npy"))
+        self.indices = np.load(
+            os.path.join(path, "indices.npy"), mmap_mode='r')
+        self.scores = np.load(
+            os.path.join(path, "scores.npy"), mmap_mode='r')
+        self.path = path
+        self.path_stamp = stamp
+        return True
+
+    def columns(self, row: int) -> np.ndarray:
+        """Templates scored against candidate row"""
+        if self.mode == 'ud':
+            return np.flatnonzero(self.sids == self.sids[row])
+        return np.flatnonzero(self.sids != self.sids[row])
+
+    def compute(self, workers: int = 1) -> None:
+        """Fill the scores, splitting rows into chunks of templates"""
+        # Every sample as a template, in dataset order
+        recognizer = Jackknife(resample_cnt=self.resample_cnt,
+                               device_type=self.dataset.device_type,
+                               window=self.window)
+        for sample in self.dataset.samples:
+            recognizer.add_template(sample)
+
+        cnt = len(self.dataset.samples)
+        rows = [self.columns(row) for row in range(cnt)]
+        self.indptr = np.zeros(cnt + 1, dtype=np.int64)
+        np.cumsum([len(cols) for cols in rows], out=self.indptr[1:])
+        self.indices = np.concatenate(rows + [np.empty(0, dtype=np.int64)])
+        self.scores = np.full(len(self.indices), np.inf)
+
+        tasks = []
+        for row in range(cnt):
+            for start in range(self.indptr[row],
+                               self.indptr[row + 1],
+                               ScoreMatrix.chunk_size):
+                end = min(start + ScoreMatrix.chunk_size,
+                          self.indptr[row + 1])
+                tasks += [(row, start, end)]
+
+        def run(task):
+            row, start, end = task
+            c = recognizer.templates[row]
+            self.scores[start:end] = recognizer.score_template(
+                c, self.indices[start:end])
+
+        with Dataset.Executor(workers) as executor:
+            for _ in executor.map(run, tasks):
+                pass
+
+        self.path = None
+        self.path_stamp = None
+
+    def lookup(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """(len(rows), len(cols)) scores; pairs not computed are inf"""
+        ret = np.full((len(rows), len(cols)), np.inf)
+        for ii, row in enumerate(rows):
+            start, end = self.indptr[row], self.indptr[row + 1]
+            if start == end:
+                continue
+            indices = self.indices[start:end]
+            pos = np.minimum(np.searchsorted(indices, cols), end - start - 1)
+            found = indices[pos] == cols
+            ret[ii, found] = self.scores[start + pos[found]]
+        return ret
+
+    def classify(self,
+                 train: List[Sample],
+                 test: List[Sample],
+                 rejection_threshold: float = np.inf) -> List[List[RecognitionResult]]:
+        """Best match of each test sample among train, as
+        Jackknife.classify_many(test, best_only=True) returns it"""
+        rows = np.array([self.index[id(t)] for t in test], dtype=np.int64)
+        cols = np.array([self.index[id(t)] for t in train], dtype=np.int64)
+        if len(cols) == 0:
+            return [None] * len(rows)
+
+        # A NaN score is never below the threshold, as in classify_many
+        scores = self.lookup(rows, cols)
+        scores[np.isnan(scores)] = np.inf
+        best = np.argmin(scores, axis=1)
+        best_scores = scores[np.arange(len(rows)), best]
+
+        ret = []
+        for col, score in zip(cols[best], best_scores):
+            if score < rejection_threshold:
+                template, = Jackknife.Template.Cached(
+                    [self.dataset.samples[col]], self.resample_cnt)
+                ret += [[RecognitionResult(float(score), template)]]
+            else:
+                ret += [None]
+        return ret
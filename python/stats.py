@@ -17,6 +17,7 @@
 
 
 from typing import Union
+import numpy as np
 
 
 class RecognitionResult(object):
@@ -89,40 +90,111 @@ class InnerConfusionMatrix(object):
 
 
 class ConfusionMatrix(object):
-    """Macro confusion matrix"""
+    """Macro confusion matrix
+
+    counts[e, c] is the number of samples of gesture id e classified as
+    gesture id c, with rejected samples in the extra last column. Ids
+    are positions in gnames.
+    """
 
     def __init__(self, gnames):
-        """Create inner matrices for each gname"""
-        self.inner_confusion_matrices = {}
-        for gname in gnames:
-            self.inner_confusion_matrices[gname] = InnerConfusionMatrix()
+        """Create a zero count matrix over gnames"""
+        self.gnames = list(dict.fromkeys(gnames))
+        self.gids = {gname: gid for gid, gname in enumerate(self.gnames)}
+        cnt = len(self.gnames)
+        self.counts = np.zeros((cnt, cnt + 1), dtype=np.int64)
+
+    @property
+    def rejected_id(self) -> int:
+        """Column of rejected samples"""
+        return len(self.gnames)
 
     def update(self,
                expected: Union[str, int, None],
                classified: Union[str, int, None]):
         """ """
+        eid = self.gids[expected]
+        cid = self.rejected_id
+        if classified is not None:
+            cid = self.gids[classified]
+        self.counts[eid, cid] += 1
+
+    def update_many(self,
+                    expected_ids: np.ndarray,
+                    classified_ids: np.ndarray):
+        """Count many results at once, by gesture id; a classified id of
+        -1 means rejected"""
+        expected_ids = np.asarray(expected_ids, dtype=np.int64)
+        classified_ids = np.asarray(classified_ids, dtype=np.int64)
+        classified_ids = np.where(classified_ids < 0,
+                                  self.rejected_id,
+                                  classified_ids)
+
+        width = self.counts.shape[1]
+        self.counts += np.bincount(
+            expected_ids * width + classified_ids,
+            minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other: 'ConfusionMatrix'):
+        """Add the counts of another matrix over the same gnames"""
+        self.counts += other.counts
+
+    def tp(self) -> np.ndarray:
+        """Per gesture true positives"""
+        return np.diagonal(self.counts[:, :-1]).astype(float)
+
+    def fp(self) -> np.ndarray:
+        """Per gesture false positives"""
+        return np.sum(self.counts[:, :-1], axis=0) - self.tp()
+
+    def fn(self) -> np.ndarray:
+        """Per gesture false negatives, rejected ones included"""
+        return np.sum(self.counts, axis=1) - self.tp()
+
+    def precision(self) -> np.ndarray:
+        """ """
+        tp = self.tp()
+        denom = tp + self.fp()
+        return np.divide(tp, denom, out=np.zeros_like(tp),
+                         where=denom != 0.0)
 
-        if classified is None:
-            expected_matrix = self.inner_confusion_matrices[expected]
-            expected_matrix.fn += 1.0
-            return
-
-        if expected == classified:
-            expected_matrix = self.inner_confusion_matrices[expected]
-            expected_matrix.tp += 1.0
-            return
-
-        if expected != classified:
-            expected_matrix = self.inner_confusion_matrices[expected]
-            classified_matrix = self.inner_confusion_matrices[classified]
-            expected_matrix.fn += 1.0
-            classified_matrix.fp += 1.0
-            return
+    def recall(self) -> np.ndarray:
+        """ """
+        tp = self.tp()
+        denom = tp + self.fn()
+        return np.divide(tp, denom, out=np.zeros_like(tp),
+                         where=denom != 0.0)
+
+    def fscores(self) -> np.ndarray:
+        """Per gesture F-scores"""
+        precision = self.precision()
+        recall = self.recall()
+        denom = precision + recall
+        numer = 2.0 * precision * recall
+        return np.divide(numer, denom, out=np.zeros_like(numer),
+                         where=denom != 0.0)
+
+    @property
+    def inner_confusion_matrices(self):
+        """Per gesture InnerConfusionMatrix of the counts"""
+        ret = {}
+        for gname, tp, fp, fn in zip(self.gnames,
+                                     self.tp().tolist(),
+                                     self.fp().tolist(),
+                                     self.fn().tolist()):
+            m = InnerConfusionMatrix()
+            m.tp = tp
+            m.fp = fp
+            m.fn = fn
+            ret[gname] = m
+        return ret
 
     def fscore(self) -> float:
         ret = 0.0
-        matrices_cnt = len(self.inner_confusion_matrices)
-        for gname, m in self.inner_confusion_matrices.items():
-            ret += m.fscore()
+        matrices_cnt = len(self.gnames)
+
+        # Summed in order, as the per gesture scores were
+        for f in self.fscores().tolist():
+            ret += f
 
         return ret / matrices_cnt
@@ -16,14 +16,18 @@
 # is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
 
 
+import contextlib
 import random
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
 from typing import List, Union
 import numpy as np
 
 import utils
 
 from dataset import Sample
-from tables import get_gpsr_coefficients, get_inflation, DeviceType
+from tables import get_gpsr_coefficients, get_inflation, get_adjustment
+from tables import DeviceType
 from jackknife import Jackknife
 from mincer import Mincer
 
@@ -31,150 +35,717 @@ from mincer import Mincer
 def select_rejection_threshold(recognizer: Jackknife,
                                device_type: DeviceType,
                                beta: float,
-                               train_cnt: int):
-    """ """
-
-    training_set = recognizer.get_training_set()
-    template_cnt = len(training_set)
+                               train_cnt: int,
+                               workers: int = 1,
+                               adaptive: bool = False,
+                               tolerance: float = 0.05,
+                               max_iterations: int = 1000,
+                               max_seconds: float = None,
+                               return_counts: bool = False):
+    """Select a rejection threshold from synthetic scores
+
+    With adaptive, synthetic scores are generated in rounds of 10 per
+    template until the bootstrap 95% interval of the threshold is within
+    tolerance of the threshold (relative), each template has
+    max_iterations scores of each kind, or max_seconds have passed.
+    Scores are streamed into a ScoreSketch per kind, so memory stays
+    bounded however many rounds are run; up to ScoreSketch.exact_cnt
+    scores, results are those of the scores themselves.
+
+    With workers > 1, templates are scored in a process pool, see
+    scoring_pool.
+
+    With return_counts, (threshold, pos_cnt, neg_cnt, round_cnt) is
+    returned: the number of positive and negative scores the threshold
+    was selected from, and the rounds it took to generate them.
+    """
 
     # Set up a negative stream
     nstream = Mincer(recognizer)
+    template_gpsr_ns(recognizer, device_type)
+
+    executor = None
+    if workers > 1:
+        executor = scoring_pool(recognizer, nstream, device_type, workers)
+
+    with executor or contextlib.nullcontext():
+        # Allocate distributions, one per template
+        iteration_cnt = 10
+        pos = ScoreSketch()
+        neg = ScoreSketch()
+        round_pos, round_neg = synthetic_scores(
+            recognizer, nstream, device_type, iteration_cnt, executor,
+            workers)
+        pos.add(round_pos)
+        neg.add(round_neg)
+        round_cnt = 1
+
+        if adaptive:
+            start = time.perf_counter()
+            while True:
+                threshold = estimate_rejection_threshold_sketch(
+                    pos, neg, beta)
+                lower, upper = bootstrap_threshold_interval_sketch(
+                    pos, neg, beta)
+                if upper - lower <= tolerance * abs(threshold):
+                    break
+                if (round_cnt + 1) * iteration_cnt > max_iterations:
+                    break
+                if max_seconds is not None and \
+                        time.perf_counter() - start >= max_seconds:
+                    break
 
-    # Allocate distributions, one per template
-    iteration_cnt = 10
-    pos: List[float] = []
-    neg: List[float] = []
-
-    for tidx in range(template_cnt):
-
-        # Generate negative samples
-        for _ in range(iteration_cnt):
-            minced_sample = nstream.mince(tidx)
-
-            score = recognizer.measure(minced_sample, tidx)
-            neg += [score]
-
-        # Get GPSR parameters
-        gpsr_r = 5
-        gpsr_n = optimal_gpsr_n(training_set[tidx].trajectory,
-                                device_type)
-
-        # Generate positive samples
-        for _ in range(iteration_cnt):
-            positive_sample = gpsr(training_set[tidx].trajectory,
-                                   n=gpsr_n,
-                                   remove_cnt=gpsr_r,
-                                   variance=0.25)
+                round_pos, round_neg = synthetic_scores(
+                    recognizer, nstream, device_type, iteration_cnt, executor,
+                    workers)
+                pos.add(round_pos)
+                neg.add(round_neg)
+                round_cnt += 1
 
-            score = recognizer.measure(positive_sample, tidx)
-            pos += [score]
+            print("samples used  : {} pos, {} neg in {} rounds".format(
+                pos.cnt, neg.cnt, round_cnt))
 
-    print("mean pos score:", np.mean(pos, axis=0))
-    print("mean neg score:", np.mean(neg, axis=0))
+    print("mean pos score:", pos.mean())
+    print("mean neg score:", neg.mean())
 
-    threshold = estimate_rejection_threshold(pos, neg, beta)
+    threshold = estimate_rejection_threshold_sketch(pos, neg, beta)
     print("found thresh  :", threshold)
-    inflation = get_inflation(device_type)
-    scale = estimate_adjustment(6, threshold, inflation, train_cnt, beta)
+    scale = select_adjustment(device_type, train_cnt, beta)
     rejection = threshold * scale
     print("after scaling :", rejection)
+
+    if return_counts:
+        return rejection, pos.cnt, neg.cnt, round_cnt
     return rejection
 
 
-def estimate_rejection_threshold(pos: List[float],
-                                 neg: List[float],
-                                 beta: Union[float, int]) -> float:
-    """"""
+def synthetic_scores(recognizer: Jackknife,
+                     nstream: Mincer,
+                     device_type: DeviceType,
+                     iteration_cnt: int,
+                     executor: Executor = None,
+                     chunk_cnt: int = 1):
+    """iteration_cnt positive and negative scores for every template, as
+    (pos, neg) lists.
 
-    pos.sort()
-    neg.sort()
+    With an executor from scoring_pool, templates are split into
+    chunk_cnt contiguous chunks, one task each.
+    """
+    template_cnt = len(recognizer.get_training_set())
+    pos: List[float] = []
+    neg: List[float] = []
 
-    pcnt = len(pos)
-    ncnt = len(neg)
+    template_gpsr_ns(recognizer, device_type)
 
-    tp = 0
-    fn = pcnt
-    fp = 0
-    best_threshold = -np.inf
-    best_fscore = -np.inf
+    # Every template has its own stream spawned from utils.rng, so
+    # results do not depend on how templates are chunked, or whether
+    # they are scored in a pool at all.
+    seeds = np.random.SeedSequence(
+        utils.rng.integers(0, 2 ** 63)).spawn(template_cnt)
 
-    pidx = 0
-    nidx = 0
+    if executor is None:
+        chunks = [score_chunk(recognizer, nstream, device_type, seeds, 0,
+                              iteration_cnt)]
+    else:
+        bounds = np.linspace(0, template_cnt, chunk_cnt + 1).astype(int)
+        tasks = [(seeds[start:end], start, iteration_cnt)
+                 for start, end in zip(bounds[:-1], bounds[1:])
+                 if start < end]
+        chunks = executor.map(score_templates, tasks)
 
-    b2 = beta * beta
-    b2p1 = b2 + 1.0
+    for chunk in chunks:
+        for tneg, tpos in chunk:
+            neg += tneg.tolist()
+            pos += tpos.tolist()
 
-    while pidx < pcnt and nidx < ncnt:
-        threshold = min(pos[pidx], neg[nidx])
+    return pos, neg
 
-        while pidx < pcnt and pos[pidx] <= threshold:
-            tp += 1
-            fn -= 1
-            pidx += 1
 
-        while nidx < ncnt and neg[nidx] <= threshold:
-            fp += 1
-            nidx += 1
+# Recognizer, negative stream and device type of a scoring worker, see
+# scoring_pool
+scoring_state = {}
 
-        # Estimate F-beta score and save if it's the best
-        fscore = b2p1 * tp
-        fscore /= ((b2p1 * tp) + (b2 * fn) + fp)
 
-        if fscore > best_fscore:
-            best_fscore = fscore
-            best_threshold = threshold
+def scoring_pool(recognizer: Jackknife,
+                 nstream: Mincer,
+                 device_type: DeviceType,
+                 workers: int) -> ProcessPoolExecutor:
+    """Process pool for synthetic_scores.
 
-    return best_threshold
+    The template store and the negative stream's prepared trajectories
+    are sent to each worker once, when it starts, rather than with every
+    task. Compute GPSR n first (template_gpsr_ns) so workers receive it.
+    """
+    return ProcessPoolExecutor(max_workers=workers,
+                               initializer=init_scoring_worker,
+                               initargs=(recognizer, nstream, device_type))
 
 
-def optimal_gpsr_n(trajectory: List,
-                   did: DeviceType):
+def init_scoring_worker(recognizer: Jackknife,
+                        nstream: Mincer,
+                        device_type: DeviceType):
     """ """
+    scoring_state["recognizer"] = recognizer
+    scoring_state["nstream"] = nstream
+    scoring_state["device_type"] = device_type
+
+
+def score_templates(task):
+    """score_chunk of a task, in a scoring worker"""
+    seeds, start, iteration_cnt = task
+    return score_chunk(scoring_state["recognizer"],
+                       scoring_state["nstream"],
+                       scoring_state["device_type"],
+                       seeds,
+                       start,
+                       iteration_cnt)
+
+
+def score_chunk(recognizer: Jackknife,
+                nstream: Mincer,
+                device_type: DeviceType,
+                seeds: List[np.random.SeedSequence],
+                start: int,
+                iteration_cnt: int):
+    """(negative, positive) scores of a contiguous chunk of templates from
+    start, each template drawing from its own seed"""
+    ret = []
+    for tidx, seed in enumerate(seeds, start):
+        rng = np.random.default_rng(seed)
+        ret += [(negative_scores(recognizer, nstream, tidx,
+                                 iteration_cnt, rng),
+                 positive_scores(recognizer, tidx, device_type,
+                                 iteration_cnt, rng))]
+    return ret
 
-    resampled = utils.uniform_resample(trajectory, 64)
 
-    minimum = np.min(resampled, axis=0)
-    maximum = np.max(resampled, axis=0)
+def bootstrap_threshold_interval(pos: Union[List[float], np.ndarray],
+                                 neg: Union[List[float], np.ndarray],
+                                 beta: Union[float, int],
+                                 resample_cnt: int = 200,
+                                 confidence: float = 0.95,
+                                 rng: np.random.Generator = None,
+                                 max_cnt: int = 1 << 10):
+    """Percentile bootstrap interval of estimate_rejection_threshold, as
+    (lower, upper)
+
+    Each side is resampled to at most max_cnt scores, so the cost does
+    not grow with the number of scores. With fewer resampled scores than
+    there are (m out of n), the resampled thresholds' deviations from the
+    full estimate are scaled by sqrt(m / n) to stand for all n.
+    """
+    if rng is None:
+        rng = utils.rng
+
+    pos = np.asarray(pos, dtype=float)
+    neg = np.asarray(neg, dtype=float)
+    if len(pos) == 0 or len(neg) == 0:
+        return -np.inf, np.inf
+
+    pcnt = min(len(pos), max_cnt)
+    ncnt = min(len(neg), max_cnt)
+    thresholds = np.empty(resample_cnt)
+    for ii in range(resample_cnt):
+        thresholds[ii] = estimate_rejection_threshold(
+            pos[rng.integers(0, len(pos), pcnt)],
+            neg[rng.integers(0, len(neg), ncnt)],
+            beta)
+
+    if pcnt < len(pos) or ncnt < len(neg):
+        threshold = estimate_rejection_threshold(pos, neg, beta)
+        scale = np.sqrt((pcnt + ncnt) / (len(pos) + len(neg)))
+        thresholds = threshold + (thresholds - threshold) * scale
+
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.quantile(thresholds, [alpha, 1.0 - alpha])
+    return float(lower), float(upper)
+
+
+def negative_scores(recognizer: Jackknife,
+                    nstream: Mincer,
+                    tidx: int,
+                    iteration_cnt: int,
+                    rng: np.random.Generator = None) -> np.ndarray:
+    """Scores of iteration_cnt minced negatives against template tidx"""
+    minced_samples = nstream.mince_batch(tidx, iteration_cnt, rng)
+    return recognizer.measure_many(minced_samples, tidx)
+
+
+def positive_scores(recognizer: Jackknife,
+                    tidx: int,
+                    device_type: DeviceType,
+                    iteration_cnt: int,
+                    rng: np.random.Generator = None) -> np.ndarray:
+    """Scores of iteration_cnt GPSR positives against template tidx"""
+    trajectory = recognizer.get_training_set()[tidx].trajectory
+
+    # Get GPSR parameters
+    gpsr_r = 5
+    gpsr_n = recognizer.templates[tidx].gpsr_n
+    if gpsr_n is None:
+        gpsr_n = optimal_gpsr_n(trajectory, device_type)
+
+    # Generate positive samples
+    positive_samples = gpsr_batch(trajectory,
+                                  n=gpsr_n,
+                                  remove_cnt=gpsr_r,
+                                  variance=0.25,
+                                  k=iteration_cnt,
+                                  rng=rng)
+
+    return recognizer.measure_many(positive_samples, tidx)
+
+
+class IncrementalThreshold(object):
+    """Rejection threshold of a recognizer, kept up to date as templates
+    are added.
+
+    Attaches itself to the recognizer and keeps one sorted pool of
+    positive and negative scores per template. When a template is added,
+    only its own pools are generated, and the negatives of at most
+    refresh_cnt templates of other gestures are regenerated, so that they
+    can splice against the new one. Templates whose gesture had nothing
+    to splice with get negatives as soon as another gesture is added.
+    The threshold is then selected from the merged pools, and scaled by
+    an adjustment that does not depend on the threshold, so it is only
+    looked up once. The pools are also kept merged into one sorted array
+    per kind, which a new or regenerated pool is merged into, so adding a
+    template does not sort every score again.
+    """
+
+    def __init__(self,
+                 recognizer: Jackknife,
+                 beta: float = 1.0,
+                 train_cnt: int = 1,
+                 iteration_cnt: int = 10,
+                 refresh_cnt: int = 4):
+        """ """
+        self.recognizer = recognizer
+        self.beta = beta
+        self.train_cnt = train_cnt
+        self.iteration_cnt = iteration_cnt
+        self.refresh_cnt = refresh_cnt
+
+        self.pos: List[np.ndarray] = []
+        self.neg: List[np.ndarray] = []
+        self.merged_pos = np.empty(0)
+        self.merged_neg = np.empty(0)
+        self.scale = None
+        self.threshold = np.inf
+
+        # One negative stream, extended as templates are added
+        self.nstream = Mincer(recognizer)
+
+        recognizer.observers += [self]
+        for tidx in range(len(recognizer.get_training_set())):
+            self.score(tidx)
+        self.refresh(range(len(self.neg)))
+        self.update()
+
+    def template_added(self, recognizer: Jackknife, tidx: int):
+        """Score the new template, refresh some negatives, update"""
+        self.score(tidx)
+
+        self.nstream.update()
+        gids = self.nstream.gids
+
+        pending = [t for t in range(tidx) if self.neg[t] is None]
+        others = [t for t in range(tidx)
+                  if self.neg[t] is not None and gids[t] != gids[tidx]]
+        if len(others) > self.refresh_cnt:
+            others = utils.rng.choice(others, self.refresh_cnt,
+                                      replace=False).tolist()
+
+        self.refresh([tidx] + pending + others)
+        self.update()
+
+    def score(self, tidx: int):
+        """Generate the positive pool of template tidx; its negatives
+        are left to refresh"""
+        pos = positive_scores(self.recognizer,
+                              tidx,
+                              self.recognizer.device_type,
+                              self.iteration_cnt)
+        self.pos += [np.sort(pos)]
+        self.neg += [None]
+        self.merged_pos = merge_sorted(self.merged_pos, self.pos[-1])
+
+    def refresh(self, tidxs, nstream: Mincer = None):
+        """Regenerate the negative pools of tidxs, where possible"""
+        if nstream is None:
+            nstream = self.nstream
+
+        for tidx in tidxs:
+            if not np.any(nstream.gids != nstream.gids[tidx]):
+                continue
+            neg = negative_scores(self.recognizer,
+                                  nstream,
+                                  tidx,
+                                  self.iteration_cnt)
+            if self.neg[tidx] is not None:
+                self.merged_neg = remove_sorted(self.merged_neg,
+                                                self.neg[tidx])
+            self.neg[tidx] = np.sort(neg)
+            self.merged_neg = merge_sorted(self.merged_neg, self.neg[tidx])
+
+    def update(self) -> float:
+        """Select the threshold from the pools and set it"""
+        if len(self.merged_pos) == 0 or len(self.merged_neg) == 0:
+            # Nothing to reject yet
+            self.threshold = np.inf
+        else:
+            threshold = estimate_rejection_threshold_sorted(
+                self.merged_pos,
+                self.merged_neg,
+                self.beta)
+
+            if self.scale is None:
+                self.scale = select_adjustment(self.recognizer.device_type,
+                                               self.train_cnt,
+                                               self.beta)
+
+            self.threshold = threshold * self.scale
+
+        self.recognizer.set_rejection_threshold(self.threshold)
+        return self.threshold
+
+
+def estimate_rejection_threshold(pos: Union[List[float], np.ndarray],
+                                 neg: Union[List[float], np.ndarray],
+                                 beta: Union[float, int]) -> float:
+    """Score threshold with the best F-beta over the synthetic scores
+
+    Every distinct score up to the smaller of the two maxima is a
+    candidate threshold, counting the scores at or below it as accepted;
+    the first candidate with the best F-beta wins. Counts come from
+    searchsorted on the sorted scores. pos and neg are not modified.
+    """
+    return estimate_rejection_threshold_sorted(
+        np.sort(np.asarray(pos, dtype=float)),
+        np.sort(np.asarray(neg, dtype=float)),
+        beta)
+
+
+def estimate_rejection_threshold_sorted(pos: np.ndarray,
+                                        neg: np.ndarray,
+                                        beta: Union[float, int]) -> float:
+    """estimate_rejection_threshold of scores that are already sorted"""
+    if len(pos) == 0 or len(neg) == 0:
+        return -np.inf
+
+    thresholds = merge_sorted(pos, neg)
+    distinct = np.ones(len(thresholds), dtype=bool)
+    distinct[1:] = thresholds[1:] != thresholds[:-1]
+    thresholds = thresholds[distinct]
+    thresholds = thresholds[thresholds <= min(pos[-1], neg[-1])]
+
+    tp = np.searchsorted(pos, thresholds, side='right')
+    fp = np.searchsorted(neg, thresholds, side='right')
+    return float(thresholds[best_fscore_index(tp, fp, len(pos), beta)])
+
+
+def merge_sorted(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Sorted array of the values of sorted arrays a and b, in linear
+    time"""
+    ret = np.empty(len(a) + len(b))
+    apos = np.arange(len(a)) + np.searchsorted(b, a, side='left')
+    ret[apos] = a
+    mask = np.ones(len(ret), dtype=bool)
+    mask[apos] = False
+    ret[mask] = b
+    return ret
 
-    prev = resampled[0]
-    curr = resampled[0]
 
-    angle = 0.0
+def remove_sorted(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Sorted array a without the values of sorted array b, each of which
+    a must hold, in linear time"""
+    pos = np.searchsorted(a, b, side='left')
+    # Skip over the earlier copies of repeated values
+    pos += np.arange(len(b)) - np.searchsorted(b, b, side='left')
+    return np.delete(a, pos)
 
-    for i in range(1, len(resampled)):
-        prev = curr
-        curr = resampled[i] - resampled[i - 1]
-        curr = utils.normalize_vector(curr)
 
-        if i < 2:
-            continue
+def best_fscore_index(tp: np.ndarray,
+                      fp: np.ndarray,
+                      pcnt: int,
+                      beta: Union[float, int]) -> int:
+    """Index of the first of the F-beta scores of (tp, fp) counts that is
+    the best"""
+    b2 = beta * beta
+    b2p1 = b2 + 1.0
 
-        dot = max(-1.0, min(1.0, float(np.dot(prev, curr))))
+    tp = np.asarray(tp, dtype=float)
+    fn = pcnt - tp
+    fscore = b2p1 * tp
+    fscore /= ((b2p1 * tp) + (b2 * fn) + fp)
+    return int(np.argmax(fscore))
+
+
+class ScoreSketch(object):
+    """Mergeable summary of a stream of non-negative scores.
+
+    Scores are kept as they are until there are more than exact_cnt of
+    them. After that they are counted in a fixed log-binned histogram:
+    bin k holds the scores in (min_value * g^(k - 1), min_value * g^k]
+    with g = 1 + relative_error, scores at or below min_value fall in the
+    first bin and those above max_value in the last.
+    """
+
+    def __init__(self,
+                 relative_error: float = 1e-3,
+                 min_value: float = 1e-6,
+                 max_value: float = 1e6,
+                 exact_cnt: int = 1 << 16):
+        """ """
+        self.relative_error = relative_error
+        self.min_value = min_value
+        self.max_value = max_value
+        self.exact_cnt = exact_cnt
+
+        # Upper edge of every histogram bin
+        growth = np.log1p(relative_error)
+        bin_cnt = int(np.ceil(np.log(max_value / min_value) / growth)) + 2
+        self.edges = min_value * np.exp(growth * np.arange(bin_cnt))
+
+        self.scores = []
+        self.counts = None
+        self.cnt = 0
+        self.total = 0.0
+
+    @property
+    def exact(self) -> bool:
+        """True while the scores themselves are kept"""
+        return self.counts is None
+
+    def add(self, scores: Union[List[float], np.ndarray]):
+        """Add a chunk of scores"""
+        scores = np.ravel(np.asarray(scores, dtype=float))
+        self.cnt += len(scores)
+        self.total += float(np.sum(scores))
+        if self.exact:
+            self.scores += [scores]
+            if self.cnt > self.exact_cnt:
+                self.bin()
+            return
+
+        self.counts += self.histogram(scores)
+
+    def merge(self, other: 'ScoreSketch'):
+        """Add the scores summarized by another sketch of the same bins"""
+        self.cnt += other.cnt
+        self.total += other.total
+        if self.exact and other.exact:
+            self.scores += other.scores
+            if self.cnt > self.exact_cnt:
+                self.bin()
+            return
+
+        if self.exact:
+            self.bin()
+        if other.exact:
+            self.counts += self.histogram(np.concatenate(
+                other.scores + [np.empty(0)]))
+        else:
+            self.counts += other.counts
+
+    def bin(self):
+        """Switch from kept scores to the histogram"""
+        scores = np.concatenate(self.scores + [np.empty(0)])
+        self.scores = []
+        self.counts = self.histogram(scores)
+
+    def histogram(self, scores: np.ndarray) -> np.ndarray:
+        """Bin counts of scores"""
+        idxs = np.searchsorted(self.edges, scores, side='left')
+        idxs = np.minimum(idxs, len(self.edges) - 1)
+        return np.bincount(idxs, minlength=len(self.edges)).astype(np.int64)
+
+    def values(self) -> np.ndarray:
+        """The kept scores, in the order they were added"""
+        return np.concatenate(self.scores + [np.empty(0)])
+
+    def sorted(self) -> np.ndarray:
+        """The kept scores, sorted"""
+        return np.sort(self.values())
+
+    def binned(self) -> np.ndarray:
+        """Bin counts of all scores"""
+        if self.exact:
+            return self.histogram(self.values())
+        return self.counts
+
+    def mean(self) -> float:
+        """Mean of all scores"""
+        if self.exact:
+            return np.mean(self.values())
+        return self.total / self.cnt
+
+
+def estimate_rejection_threshold_sketch(pos: ScoreSketch,
+                                        neg: ScoreSketch,
+                                        beta: Union[float, int]) -> float:
+    """estimate_rejection_threshold from sketches of pos and neg scores
+
+    While both sketches still keep their scores, the result is exact.
+    Otherwise thresholds are resolved to histogram bins: the result is the
+    upper edge of the first bin with the best F-beta. A bin's edge accepts
+    exactly the scores up to its bin, so for scores within [min_value,
+    max_value] its F-beta is the actual one. The edge of the bin holding
+    the exact threshold accepts at most the m scores of that bin on top,
+    which bounds what is lost against the best F-beta, with P positives:
+
+        F(exact) - F(result) <= m / (beta^2 * P + m)
+
+    The threshold itself has no such bound; where F-beta is flat it can
+    be many bins away from the exact one.
+    """
+    if pos.exact and neg.exact:
+        return estimate_rejection_threshold(pos.sorted(), neg.sorted(), beta)
+
+    if pos.cnt == 0 or neg.cnt == 0:
+        return -np.inf
+    return estimate_rejection_threshold_binned(
+        pos.binned(), neg.binned(), pos.edges, beta)
+
+
+def estimate_rejection_threshold_binned(pcounts: np.ndarray,
+                                        ncounts: np.ndarray,
+                                        edges: np.ndarray,
+                                        beta: Union[float, int]) -> float:
+    """Upper edge of the first bin with the best F-beta, given bin counts
+    of pos and neg scores"""
+    pcnt = np.sum(pcounts)
+    ncnt = np.sum(ncounts)
+
+    # As with the scores themselves: nonempty bins, up to the one where
+    # either side runs out
+    tp = np.cumsum(pcounts)
+    fp = np.cumsum(ncounts)
+    used = (pcounts + ncounts) > 0
+    used &= (tp - pcounts < pcnt) & (fp - ncounts < ncnt)
+
+    tp = tp[used]
+    fp = fp[used]
+    return float(edges[used][best_fscore_index(tp, fp, pcnt, beta)])
+
+
+def bootstrap_threshold_interval_sketch(pos: ScoreSketch,
+                                        neg: ScoreSketch,
+                                        beta: Union[float, int],
+                                        resample_cnt: int = 200,
+                                        confidence: float = 0.95,
+                                        rng: np.random.Generator = None):
+    """bootstrap_threshold_interval from sketches of pos and neg scores
+
+    While both sketches still keep their scores, the result is that of
+    the scores themselves. Otherwise bin counts are resampled, so the
+    cost depends on the number of bins, not of scores.
+    """
+    if pos.exact and neg.exact:
+        return bootstrap_threshold_interval(
+            pos.values(), neg.values(), beta, resample_cnt, confidence, rng)
+
+    if rng is None:
+        rng = utils.rng
+
+    if pos.cnt == 0 or neg.cnt == 0:
+        return -np.inf, np.inf
+
+    # Only bins that hold a score of either kind can
+    pcounts = pos.binned()
+    ncounts = neg.binned()
+    used = (pcounts + ncounts) > 0
+    pcounts = pcounts[used]
+    ncounts = ncounts[used]
+    edges = pos.edges[used]
+
+    thresholds = np.empty(resample_cnt)
+    for ii in range(resample_cnt):
+        thresholds[ii] = estimate_rejection_threshold_binned(
+            rng.multinomial(pos.cnt, pcounts / pos.cnt),
+            rng.multinomial(neg.cnt, ncounts / neg.cnt),
+            edges,
+            beta)
+
+    alpha = (1.0 - confidence) / 2.0
+    lower, upper = np.quantile(thresholds, [alpha, 1.0 - alpha])
+    return float(lower), float(upper)
 
-        theta = np.arccos(dot)
-        angle += theta
 
-    # print(f"{angle=}")
+def optimal_gpsr_n(trajectory: List,
+                   did: DeviceType):
+    """ """
+    return int(optimal_gpsr_n_batch([trajectory], did)[0])
 
-    diagonal = np.linalg.norm(maximum - minimum)
-    length = utils.path_length(trajectory)
-    density = length / diagonal
 
-    # print(f"{diagonal=}")
-    # print(f"{length=}")
-    # print(f"{density=}")
-    # print()
+def optimal_gpsr_n_batch(trajectories: List,
+                         did: DeviceType) -> np.ndarray:
+    """optimal_gpsr_n of every trajectory, from batched features"""
+    density, angle = gpsr_features(trajectories)
 
     gpsr_co = get_gpsr_coefficients()
 
-    ret = gpsr_co.intercept
+    ret = np.full(len(trajectories), gpsr_co.intercept)
     ret += gpsr_co.density_co * density
     ret += gpsr_co.angle_co * angle
     ret += gpsr_co.density_angle_co * density * angle
 
-    return round(ret)
+    return np.rint(ret).astype(np.int64)
 
 
+def gpsr_features(trajectories: List):
+    """Path density and total turning angle of every trajectory
+
+    Each trajectory is resampled to 64 points. The angle sums the turns
+    between consecutive normalized segments; a turn next to a zero length
+    segment counts as 0. Density is the path length over the bounding box
+    diagonal of the resampled points.
+    """
+    if len(trajectories) == 0:
+        return np.empty(0), np.empty(0)
+
+    resampled = np.array(
+        [utils.uniform_resample(trajectory, 64)
+         for trajectory in trajectories])
+
+    minimum = np.min(resampled, axis=1)
+    maximum = np.max(resampled, axis=1)
+
+    vecs = np.diff(resampled, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vecs /= np.linalg.norm(vecs, axis=2, keepdims=True)
+
+    dots = np.einsum('kij,kij->ki', vecs[:, :-1], vecs[:, 1:])
+    dots = np.where(dots < 1.0, dots, 1.0)
+    dots = np.where(dots > -1.0, dots, -1.0)
+
+    # Summed in order, as the turns were accumulated one at a time
+    angle = np.add.accumulate(np.arccos(dots), axis=1)[:, -1]
+
+    diagonal = np.linalg.norm(maximum - minimum, axis=1)
+    length = np.array(
+        [utils.path_length(trajectory) for trajectory in trajectories])
+    density = length / diagonal
+
+    return density, angle
+
+
+def template_gpsr_ns(recognizer: Jackknife,
+                     device_type: DeviceType) -> np.ndarray:
+    """GPSR n of every template of recognizer
+
+    Templates without one are computed in one batch, and the result is
+    kept on the template, so later threshold selections reuse it.
+    """
+    templates = recognizer.templates
+    missing = [t for t in templates if t.gpsr_n is None]
+    if missing:
+        ns = optimal_gpsr_n_batch(
+            [t.sample.trajectory for t in missing], device_type)
+        for template, n in zip(missing, ns.tolist()):
+            template.gpsr_n = n
+    return np.array([t.gpsr_n for t in templates], dtype=np.int64)
+
 
 # Perform Gesture Path Stochastic Resampling (GPSR) to create a synthetic
 # variation of the given trajectory:
@@ -212,52 +783,170 @@ def gpsr(pts: Union[list, np.ndarray],
     return ret
 
 
+def gpsr_batch(pts: Union[list, np.ndarray],
+               n: int = 0,
+               remove_cnt: int = 1,
+               variance: float = 0.25,
+               k: int = 1,
+               rng: np.random.Generator = None) -> np.ndarray:
+    """ Create k GPSR variations of pts at once; returns a (k, n, d) array.
+
+    Same procedure as gpsr(), but the random intervals and removals are
+    drawn for all k variations together from rng (utils.rng by default).
+    """
+    if rng is None:
+        rng = utils.rng
+
+    # first stochastically resample trajectory, k times
+    m = n + remove_cnt
+    scale = (12 * variance) ** .5
+    intervals = 1.0 + rng.uniform(0, 1, (k, m - 1)) * scale
+    intervals /= np.sum(intervals, axis=1, keepdims=True)
+    pts = utils.resample_intervals(pts, intervals)
+
+    # then remove some random points; removal idx picks one of the
+    # m - idx points still left, as gpsr() does with np.delete
+    keep = np.ones((k, m), dtype=bool)
+    rows = np.arange(k)
+    for idx in range(remove_cnt):
+        gotta_go = rng.integers(0, m - idx, size=k)
+        left = np.cumsum(keep, axis=1)
+        keep[rows, np.argmax(left > gotta_go[:, None], axis=1)] = False
+    pts = pts[keep].reshape(k, n, -1)
+
+    # And last, normalize and concatenate the
+    # between point vectors.
+    delta = np.diff(pts, axis=1)
+    delta /= np.linalg.norm(delta, axis=2, keepdims=True)
+
+    ret = np.empty(pts.shape)
+    ret[:, 0] = 0.0
+    np.cumsum(delta, axis=1, out=ret[:, 1:])
+    return ret
+
+
 def estimate_adjustment(dimension: float,
                         threshold: float,
                         inflation: float,
                         train_cnt: int,
-                        beta: float, ) -> float:
-    """"""
+                        beta: float,
+                        trial_cnt: int = 100000,
+                        rng: np.random.Generator = None) -> float:
+    """Monte Carlo estimate of the threshold scale with the best F-beta
+
+    Test points are drawn in a ball large enough for every scale and
+    count as positives inside the inflated radius; they are recognized
+    when within the scaled threshold of one of train_cnt points drawn in
+    the training ball. Every scale is evaluated on the same draws, so the
+    differences between scales, which pick the best one, are not buried
+    in the noise of separate draws: a trial's distance to its nearest
+    training point decides at once which scales recognize it. The result
+    does not depend on threshold, which only sets the units.
+    """
+    if rng is None:
+        rng = utils.rng
+
+    dimension = int(dimension)
     rt = threshold  # radius training
     ri = threshold * inflation  # radius inflated
-    best_fscore = 0
-    adjustment = 0
 
+    # 0.5 to 2 in steps of 0.05, accumulated as scale += 0.05 would be
+    scales = []
     scale = 0.5
     while scale <= 2:
-        tp = 0.0
-        fp = 0.0
-        fn = 0.0
-
-        rmax = max(ri, rt + rt * scale)
-        for ii in range(0, 1000):
-            test = sample_sphere(rmax, dimension)
-            inside = np.linalg.norm(test) <= ri
-            recognized = False
-
-            for train_no in range(train_cnt):
-                tpt = sample_sphere(rt, dimension)
-                l2 = np.linalg.norm(tpt - test)
-                if l2 <= rt * scale:
-                    recognized = True
-                    break
-
-            if inside and recognized:
-                tp += 1
-            if inside and not recognized:
-                fn += 1
-            if not inside and recognized:
-                fp += 1
-
-        fscore = calculate_fscore(beta, tp, fp, fn)
+        scales += [scale]
+        scale += 0.05
+    scales = np.array(scales)
+    rmax = max(ri, rt + rt * scales[-1])
+    radius = rt * scales
+
+    tp = np.zeros(len(scales))
+    fp = np.zeros(len(scales))
+    fn = np.zeros(len(scales))
+
+    chunk = 100000
+    for start in range(0, trial_cnt, chunk):
+        cnt = min(chunk, trial_cnt - start)
+        test = sample_ball(rmax, dimension, (cnt,), rng)
+        inside = np.linalg.norm(test, axis=-1) <= ri
+
+        nearest = np.full(cnt, np.inf)
+        for train_no in range(train_cnt):
+            tpt = sample_ball(rt, dimension, (cnt,), rng)
+            np.minimum(nearest, np.linalg.norm(tpt - test, axis=-1),
+                       out=nearest)
+
+        # Recognized at every scale whose radius reaches the nearest point
+        pos = np.sort(nearest[inside])
+        neg = np.sort(nearest[~inside])
+        recognized = np.searchsorted(pos, radius, side='right')
+        tp += recognized
+        fn += len(pos) - recognized
+        fp += np.searchsorted(neg, radius, side='right')
 
-        if fscore > best_fscore:
-            best_fscore = fscore
-            adjustment = scale
+    b2 = beta * beta
+    b2p1 = b2 + 1.0
+    fscores = (b2p1 * tp) / np.maximum((b2p1 * tp) + (b2 * fn) + fp, 1)
+
+    # First scale with the best F-beta, or 0 if none is above 0
+    best = int(np.argmax(fscores))
+    if fscores[best] > 0:
+        return float(scales[best])
+    return 0
+
+
+def select_adjustment(device_type: DeviceType,
+                      train_cnt: int,
+                      beta: float) -> float:
+    """Threshold scale from the precomputed table in tables, or estimated
+    if the table has no entry"""
+    ret = get_adjustment(device_type, train_cnt, beta)
+    if ret is None:
+        inflation = get_inflation(device_type)
+        ret = estimate_adjustment(6, 1.0, inflation, train_cnt, beta)
+    return ret
 
-        scale += 0.05
 
-    return adjustment
+def build_adjustment_table(path: str,
+                           device_types: List[DeviceType],
+                           train_cnts: List[int],
+                           betas: List[float],
+                           trial_cnt: int = 10000000,
+                           seed: int = 0):
+    """Write the table get_adjustment reads, with trial_cnt trials per
+    entry drawn from seed, both of which are recorded in the header"""
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as fout:
+        fout.write("# build_adjustment_table trial_cnt={} seed={}\n".format(
+            trial_cnt, seed))
+        fout.write("device,train_cnt,beta,adjustment\n")
+        for device_type in device_types:
+            inflation = get_inflation(device_type)
+            for train_cnt in train_cnts:
+                for beta in betas:
+                    adjustment = estimate_adjustment(
+                        6, 1.0, inflation, train_cnt, beta, trial_cnt, rng)
+                    fout.write("{},{},{},{}\n".format(
+                        device_type.name, train_cnt, beta, adjustment))
+
+
+def sample_ball(radius: Union[float, np.ndarray],
+                dimension: int,
+                shape: tuple,
+                rng: np.random.Generator = None) -> np.ndarray:
+    """Points uniformly distributed in a ball, shape + (dimension,)
+
+    A Gaussian direction scaled by radius * U^(1 / dimension); radius
+    broadcasts against shape.
+    """
+    if rng is None:
+        rng = utils.rng
+
+    pts = rng.standard_normal(tuple(shape) + (dimension,))
+    pts /= np.linalg.norm(pts, axis=-1, keepdims=True)
+    pts *= (np.asarray(radius) *
+            rng.uniform(0, 1, shape) ** (1.0 / dimension))[..., None]
+    return pts
 
 
 def sample_sphere(radius: float,
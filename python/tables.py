@@ -17,6 +17,8 @@
 
 
 from enum import Enum
+import csv
+import os
 
 
 class DeviceType(Enum):
@@ -93,3 +95,26 @@ def get_device_dataset_path(device_type: DeviceType):
         return "../datasets/vive/training"
     if device_type == DeviceType.MOUSE:
         return "../datasets/mouse/training"
+
+
+# Threshold adjustments by (device name, train_cnt, beta), precomputed
+# with synthetic.build_adjustment_table; read on first use
+adjustments_path = os.path.join(os.path.dirname(__file__), "adjustments.csv")
+adjustments = None
+
+
+def get_adjustment(device_type: DeviceType, train_cnt: int, beta: float):
+    """Precomputed threshold adjustment, or None if not in the table"""
+    global adjustments
+    if adjustments is None:
+        adjustments = {}
+        if os.path.exists(adjustments_path):
+            with open(adjustments_path, newline="") as fin:
+                # Lines starting with # record how the table was built
+                lines = (line for line in fin if not line.startswith("#"))
+                for row in csv.DictReader(lines):
+                    key = (row["device"],
+                           int(row["train_cnt"]),
+                           float(row["beta"]))
+                    adjustments[key] = float(row["adjustment"])
+    return adjustments.get((device_type.name, int(train_cnt), float(beta)))
@@ -0,0 +1,284 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+import os
+import struct
+
+import numpy as np
+import pytest
+
+from dataset import Dataset, Sample
+from tables import DeviceType
+
+
+def write_sample(path, gname, trajectory, times_s, speed=1):
+    """Write a sample file in the format Sample.Load reads"""
+    trajectory = np.asarray(trajectory, dtype="<f4")
+    name = gname.encode()
+    with open(path, "wb") as fout:
+        fout.write(struct.pack("<B", len(name)))
+        fout.write(name)
+        fout.write(struct.pack("<III", speed, *trajectory.shape))
+        fout.write(trajectory.tobytes())
+        fout.write(struct.pack("<I", len(times_s)))
+        fout.write(np.asarray(times_s, dtype="<f4").tobytes())
+
+
+def load_reference(epath):
+    """The original one value at a time loader"""
+    trajectory = []
+    times_s = []
+
+    with open(epath, "rb") as fin:
+        str_cnt, = struct.unpack("<B", fin.read(1))
+        _gname, = struct.unpack("{}s".format(str_cnt), fin.read(str_cnt))
+        speed, pt_cnt, component_cnt = struct.unpack("<III", fin.read(4 * 3))
+
+        bad = []
+        for pt_no in range(pt_cnt):
+            pt = []
+            for component_no in range(component_cnt):
+                val, = struct.unpack("<f", fin.read(4))
+                pt += [val]
+
+            if np.count_nonzero(pt) == 0:
+                bad += [pt_no]
+                continue
+
+            if len(trajectory) and np.array_equal(trajectory[-1], pt):
+                bad += [pt_no]
+                continue
+
+            trajectory += [np.array(pt)]
+
+        timestamp_cnt, = struct.unpack("<I", fin.read(4))
+        assert timestamp_cnt == pt_cnt
+
+        for pt_no in range(timestamp_cnt):
+            val, = struct.unpack("<f", fin.read(4))
+            if pt_no in bad:
+                continue
+            times_s += [val]
+
+    return np.array(trajectory), np.array(times_s)
+
+
+def make_trajectory(rng, pt_cnt, component_cnt):
+    """Random frames with dropped (all zero) and repeated frames mixed in"""
+    trajectory = rng.normal(size=(pt_cnt, component_cnt))
+
+    # Some components are exactly zero without the frame being dropped
+    trajectory[rng.uniform(size=trajectory.shape) < 0.1] = 0.0
+
+    for pt_no in range(1, pt_cnt):
+        draw = rng.uniform()
+        if draw < 0.2:
+            trajectory[pt_no] = 0.0
+        elif draw < 0.5:
+            trajectory[pt_no] = trajectory[pt_no - 1]
+
+    # Runs of repeats separated by dropped frames
+    if pt_cnt >= 4:
+        trajectory[2] = 0.0
+        trajectory[3] = trajectory[1]
+
+    return trajectory
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("component_cnt", [2, 3, 63])
+def test_load_matches_reference(tmp_path, seed, component_cnt):
+    rng = np.random.default_rng(seed)
+    pt_cnt = int(rng.integers(1, 200))
+    trajectory = make_trajectory(rng, pt_cnt, component_cnt)
+    times_s = np.cumsum(rng.uniform(0.01, 0.05, pt_cnt))
+
+    epath = str(tmp_path / "sample.bin")
+    write_sample(epath, "swipe", trajectory, times_s)
+
+    expected_trajectory, expected_times_s = load_reference(epath)
+    sample = Sample.Load("s1", "swipe", "e1", epath, 0)
+
+    assert sample.trajectory.dtype == np.float64
+    assert sample.time_s.dtype == np.float64
+    np.testing.assert_array_equal(
+        sample.trajectory,
+        expected_trajectory.reshape(-1, component_cnt))
+    np.testing.assert_array_equal(sample.time_s, expected_times_s)
+
+
+def test_load_drops_leading_zero_and_repeated_frames(tmp_path):
+    trajectory = [[0, 0], [1, 2], [1, 2], [0, 0], [1, 2], [3, 4], [3, 4]]
+    times_s = [0, 1, 2, 3, 4, 5, 6]
+
+    epath = str(tmp_path / "sample.bin")
+    write_sample(epath, "circle", trajectory, times_s)
+
+    sample = Sample.Load("s1", "circle", "e1", epath, 0)
+    np.testing.assert_array_equal(sample.trajectory, [[1, 2], [3, 4]])
+    np.testing.assert_array_equal(sample.time_s, [1, 5])
+
+    expected_trajectory, expected_times_s = load_reference(epath)
+    np.testing.assert_array_equal(sample.trajectory, expected_trajectory)
+    np.testing.assert_array_equal(sample.time_s, expected_times_s)
+
+
+def make_dataset(path, seed=0, snames=("s1", "s2"), gnames=("g1", "g2"),
+                 example_cnt=2, pt_cnt=None):
+    """Write a dataset of random samples under path/<subject>/<gesture>,
+    of pt_cnt frames each if given"""
+    rng = np.random.default_rng(seed)
+    for sname in snames:
+        for gname in gnames:
+            os.makedirs(os.path.join(path, sname, gname))
+            for ex in range(example_cnt):
+                write_random_sample(
+                    os.path.join(path, sname, gname, "ex{}".format(ex)),
+                    gname, rng, pt_cnt)
+    return str(path)
+
+
+def write_random_sample(epath, gname, rng, pt_cnt=None):
+    """Write a sample of pt_cnt (or a random number of) random frames"""
+    if pt_cnt is None:
+        pt_cnt = int(rng.integers(20, 40))
+    write_sample(epath, gname, rng.normal(size=(pt_cnt, 3)),
+                 np.arange(pt_cnt) / 30.0)
+
+
+def assert_same_samples(samples, expected):
+    """Same names, pids, order and values"""
+    assert [(s.sname, s.gname, s.ename, s.pid) for s in samples] == \
+        [(s.sname, s.gname, s.ename, s.pid) for s in expected]
+    for sample, other in zip(samples, expected):
+        np.testing.assert_array_equal(sample.trajectory, other.trajectory)
+        np.testing.assert_array_equal(sample.time_s, other.time_s)
+
+
+@pytest.mark.parametrize("filter", [False, True])
+def test_cache_matches_load(tmp_path, capsys, filter):
+    path = make_dataset(tmp_path / "data")
+    expected = Dataset.Load(path, DeviceType.KINECT, filter=filter)
+
+    built = Dataset.Load(path, DeviceType.KINECT, filter=filter, cache=True)
+    cached = Dataset.Load(path, DeviceType.KINECT, filter=filter, cache=True)
+
+    cache_path = Dataset.CachePath(path, filter=filter)
+    assert "Load {}".format(cache_path) in capsys.readouterr().out
+    assert_same_samples(built.samples, expected.samples)
+    assert_same_samples(cached.samples, expected.samples)
+
+
+@pytest.mark.parametrize("change", ["modify", "add", "remove"])
+def test_cache_is_rebuilt_when_files_change(tmp_path, capsys, change):
+    path = make_dataset(tmp_path / "data")
+    Dataset.Load(path, DeviceType.KINECT, cache=True)
+    capsys.readouterr()
+
+    rng = np.random.default_rng(1)
+    if change == "modify":
+        write_random_sample(os.path.join(path, "s1", "g1", "ex0"), "g1",
+                            rng, pt_cnt=50)
+    elif change == "add":
+        write_random_sample(os.path.join(path, "s2", "g2", "ex9"), "g2", rng)
+    else:
+        os.remove(os.path.join(path, "s2", "g1", "ex1"))
+
+    cached = Dataset.Load(path, DeviceType.KINECT, cache=True)
+    assert "Load {}".format(Dataset.CachePath(path)) not in \
+        capsys.readouterr().out
+    assert_same_samples(cached.samples,
+                        Dataset.Load(path, DeviceType.KINECT).samples)
+
+    # And is used again once rebuilt
+    Dataset.Load(path, DeviceType.KINECT, cache=True)
+    assert "Load {}".format(Dataset.CachePath(path)) in \
+        capsys.readouterr().out
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+@pytest.mark.parametrize("criteria", [{}, {"sexclude": ["s2"]}])
+def test_workers_match_serial_load(tmp_path, lazy, criteria):
+    # Subjects are created out of order so that listing order differs
+    path = make_dataset(tmp_path / "data", snames=("s3", "s1", "s4", "s2"),
+                        gnames=("g2", "g1", "g3"), example_cnt=3)
+
+    serial = Dataset.Load(path, DeviceType.KINECT, criteria=criteria,
+                          lazy=lazy)
+    for workers in (2, 4):
+        parallel = Dataset.Load(path, DeviceType.KINECT, criteria=criteria,
+                                workers=workers, lazy=lazy)
+        assert_same_samples(parallel.samples, serial.samples)
+
+    # pids follow the sorted subjects that are loaded
+    snames = sorted({s.sname for s in serial.samples})
+    assert [s.pid for s in serial.samples] == \
+        [snames.index(s.sname) for s in serial.samples]
+    assert [s.sname for s in serial.samples] == \
+        sorted(s.sname for s in serial.samples)
+
+
+@pytest.mark.parametrize("filter", [False, True])
+def test_lazy_matches_eager_load(tmp_path, filter):
+    path = make_dataset(tmp_path / "data")
+    eager = Dataset.Load(path, DeviceType.KINECT, filter=filter)
+    lazy = Dataset.Load(path, DeviceType.KINECT, filter=filter, lazy=True,
+                        cache_bytes=0)
+    assert all(s._trajectory is None for s in lazy.samples)
+    assert_same_samples(lazy.samples, eager.samples)
+
+
+def test_lazy_cache_evicts_least_recently_used(tmp_path):
+    pt_cnt = 30
+    path = make_dataset(tmp_path / "data", pt_cnt=pt_cnt)
+
+    # Three decoded samples: float64 trajectories of 3 components and
+    # their time stamps
+    entry_bytes = pt_cnt * 3 * 8 + pt_cnt * 8
+    ds = Dataset.Load(path, DeviceType.KINECT, lazy=True,
+                      cache_bytes=3 * entry_bytes)
+    store = ds.samples[0].store
+    samples = ds.samples
+
+    for idx in [0, 1, 2, 0, 3]:
+        samples[idx].trajectory
+        assert store.nbytes <= store.max_bytes
+    assert list(store.entries) == [samples[idx].fname for idx in [2, 0, 3]]
+
+    # The most recent sample is kept even when it alone is over budget
+    store.max_bytes = entry_bytes // 2
+    samples[4].trajectory
+    assert list(store.entries) == [samples[4].fname]
+
+
+def test_lazy_filter_drops_unfiltered_entries(tmp_path):
+    path = make_dataset(tmp_path / "data")
+    eager = Dataset.Load(path, DeviceType.KINECT)
+    lazy = Dataset.Load(path, DeviceType.KINECT, lazy=True)
+    store = lazy.samples[0].store
+
+    np.testing.assert_array_equal(lazy.samples[0].trajectory,
+                                  eager.samples[0].trajectory)
+    assert len(store.entries) == 1
+
+    # Filtering applies on decode, so earlier decodes are dropped
+    lazy.run_filter()
+    assert len(store.entries) == 0
+    for sample, other in zip(lazy.samples, eager.samples):
+        np.testing.assert_array_equal(sample.trajectory,
+                                      Dataset.Filter(other.trajectory))
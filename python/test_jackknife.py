@@ -0,0 +1,189 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+
+import numpy as np
+import pytest
+
+from dataset import Sample
+from jackknife import Jackknife, TemplateCache
+from tables import DeviceType
+from utils import uniform_resample, norm_diagonal
+
+
+def norm_comp_len_reference(pts):
+    """The original component-wise absolute distance"""
+    abs_comp_len = np.full(pts.shape[1], 0)
+    for p in pts:
+        for idx, m in enumerate(p):
+            abs_comp_len[idx] += abs(m)
+    return abs_comp_len / np.linalg.norm(abs_comp_len)
+
+
+def vectorize_reference(pts):
+    vecs = []
+    for i in range(1, len(pts)):
+        vec = pts[i] - pts[i - 1]
+        length = np.linalg.norm(vec)
+        if length == 0.0:
+            vecs += [vec]
+            continue
+        vecs += [vec / length]
+    return vecs
+
+
+def dtw_reference(cvecs, tvecs, window):
+    n = len(cvecs)
+    dtw = np.full((n + 1, n + 1), np.inf)
+    dtw[0, 0] = 0.0
+    for ii in range(1, n + 1):
+        for jj in range(max(1, ii - window), min(ii + window, n) + 1):
+            cost = 1 - np.dot(cvecs[ii - 1], tvecs[jj - 1])
+            dtw[ii, jj] = min(dtw[ii - 1, jj],
+                              dtw[ii, jj - 1],
+                              dtw[ii - 1, jj - 1]) + cost
+    return dtw[n, n]
+
+
+def classify_reference(samples, candidate, n, window, rejection_threshold):
+    """The original one template at a time classify, as (sample, score)"""
+
+    def template(sample):
+        pts = uniform_resample(sample.trajectory, n)
+        return (vectorize_reference(pts),
+                norm_comp_len_reference(pts),
+                norm_diagonal(pts))
+
+    cvecs, cabs, cbb = template(candidate)
+    ret = []
+    for sample in samples:
+        tvecs, tabs, tbb = template(sample)
+        cf = 1.0
+        cf *= 1.0 / max(0.01, np.dot(cabs, tabs))
+        cf *= 1.0 / max(0.01, np.dot(cbb, tbb))
+        score = cf * dtw_reference(cvecs, tvecs, window)
+        if score < rejection_threshold:
+            ret += [(score, sample)]
+
+    if len(ret) == 0:
+        return None
+    return sorted(ret, key=lambda r: r[0])
+
+
+def make_samples(kind, cnt, seed):
+    """Random walks, whose correction factors are finite, or unit vectors,
+    whose components are all below 1 and so have a NaN abs"""
+    rng = np.random.default_rng(seed)
+    ret = []
+    for idx in range(cnt):
+        pt_cnt = int(rng.integers(20, 50))
+        if kind == "walk":
+            trajectory = np.cumsum(rng.normal(size=(pt_cnt, 3)), axis=0)
+        else:
+            trajectory = np.cumsum(rng.normal(size=(pt_cnt, 4)) * 0.1, axis=0)
+            trajectory /= np.linalg.norm(trajectory, axis=1, keepdims=True)
+        ret += [Sample("s0", "g{}".format(idx % 3), "e{}".format(idx), 0,
+                       trajectory, np.arange(pt_cnt) / 30.0)]
+    return ret
+
+
+@pytest.mark.parametrize("kind", ["walk", "unit"])
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("threshold", [np.inf, 3.0])
+def test_classify_matches_reference(kind, seed, threshold):
+    samples = make_samples(kind, 12, seed)
+    train, test = samples[:9], samples[9:]
+
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    for sample in train:
+        recognizer.add_template(sample)
+    recognizer.set_rejection_threshold(threshold)
+
+    many = recognizer.classify_many(test)
+    best = recognizer.classify_many(test, best_only=True)
+    for candidate, results, best_results in zip(test, many, best):
+        expected = classify_reference(
+            train, candidate, 16, recognizer.window, threshold)
+        single = recognizer.classify(candidate)
+        assert (single is None) == (results is None)
+        if single is not None:
+            assert [r.score for r in single] == [r.score for r in results]
+
+        if expected is None:
+            assert results is None and best_results is None
+            continue
+
+        assert [r.template.sample for r in results] == \
+            [sample for _, sample in expected]
+        np.testing.assert_allclose([r.score for r in results],
+                                   [score for score, _ in expected],
+                                   rtol=1e-9)
+        assert len(best_results) == 1
+        assert best_results[0].template.sample is expected[0][1]
+
+
+def test_unit_data_has_nan_abs():
+    sample, = make_samples("unit", 1, 0)
+    template, = Jackknife.Template.Batch([sample], 16)
+    assert np.isnan(template.abs).all()
+
+
+@pytest.mark.parametrize("kind", ["walk", "unit"])
+@pytest.mark.parametrize("pair_cnt", [1, 7, 1 << 10])
+@pytest.mark.parametrize("best_only", [False, True])
+def test_classify_many_matches_classify(monkeypatch, kind, pair_cnt,
+                                        best_only):
+    samples = make_samples(kind, 60, 5)
+    train, test = samples[:45], samples[45:]
+
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    for sample in train:
+        recognizer.add_template(sample)
+    scores = [r.score for c in test for r in recognizer.classify(c)]
+    recognizer.set_rejection_threshold(np.median(scores))
+
+    monkeypatch.setattr(Jackknife, "pair_cnt", pair_cnt)
+    many = recognizer.classify_many(test, best_only)
+    for candidate, results in zip(test, many):
+        expected = recognizer.classify(candidate, best_only)
+        if expected is None:
+            assert results is None
+            continue
+        assert [(r.score, r.template) for r in results] == \
+            [(r.score, r.template) for r in expected]
+
+
+def test_template_cache_is_byte_bounded():
+    samples = make_samples("walk", 20, 0)
+    template, = Jackknife.Template.Batch(samples[:1], 16)
+    template.envelope(2)
+    cache = TemplateCache(5 * template.nbytes)
+
+    for sample in samples:
+        template, = Jackknife.Template.Batch([sample], 16)
+        cache.put(template, 16)
+        template.envelope(2)
+
+        # The envelope is counted once the template is used again
+        assert cache.get(sample, 16) is template
+        assert cache.nbytes == sum(
+            t.nbytes for t, _ in cache.entries.values())
+        assert cache.nbytes <= cache.max_bytes
+
+    assert len(cache.entries) == 5
+    assert cache.get(samples[0], 16) is None
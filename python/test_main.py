@@ -0,0 +1,47 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+
+from concurrent.futures import ProcessPoolExecutor
+
+import main
+import utils
+
+
+def first_draw(fold_seed):
+    """Seed a fold as run_task does and return its first draw"""
+    utils.seed(fold_seed)
+    return utils.rng.random()
+
+
+def test_fold_seeds_are_reproducible():
+    assert main.fold_seeds(7, 4) == main.fold_seeds(7, 4)
+    assert main.fold_seeds(7, 4) != main.fold_seeds(8, 4)
+
+
+def test_folds_in_separate_workers_draw_differently():
+    # Workers forked from the same parent start from the same generator
+    utils.seed(0)
+    fold_seeds = main.fold_seeds(None, 4)
+    assert len(set(fold_seeds)) == 4
+
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        draws = list(executor.map(first_draw, fold_seeds))
+
+    assert len(set(draws)) == 4
+    assert draws == [first_draw(fold_seed) for fold_seed in fold_seeds]
@@ -0,0 +1,114 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+
+import numpy as np
+
+from dataset import Sample
+from jackknife import Jackknife
+from mincer import Mincer, PreparedCache
+from tables import DeviceType
+
+
+def make_samples(cnt, component_cnt=3, seed=0):
+    rng = np.random.default_rng(seed)
+    return [Sample("s0", "g{}".format(idx % 3), "e{}".format(idx), 0,
+                   np.cumsum(rng.normal(size=(30, component_cnt)), axis=0),
+                   np.arange(30) / 30.0)
+            for idx in range(cnt)]
+
+
+def expected(samples):
+    return np.array([Mincer.prepare_trajectory(s) for s in samples])
+
+
+# Bytes of one prepared row of make_samples
+ROW_BYTES = expected(make_samples(1))[0].nbytes
+
+
+def test_get_many_is_bounded():
+    cache = PreparedCache(max_bytes=8 * ROW_BYTES)
+    samples = make_samples(20)
+
+    for start in range(0, 20, 4):
+        batch = samples[start:start + 4]
+        np.testing.assert_array_equal(cache.get_many(batch), expected(batch))
+        assert len(cache.rows) <= 8
+        assert cache.nbytes <= cache.max_bytes
+        assert len(cache.stores[3][0]) <= 8
+
+    # Only the 8 most recently used samples are still held
+    assert set(cache.rows) == {id(s) for s in samples[12:]}
+
+
+def test_get_many_larger_than_bound():
+    cache = PreparedCache(max_bytes=4 * ROW_BYTES)
+    samples = make_samples(10)
+
+    np.testing.assert_array_equal(cache.get_many(samples), expected(samples))
+    assert len(cache.rows) == 4
+
+    # The array grew to hold the call, and was compacted back, keeping
+    # the most recent rows
+    assert len(cache.stores[3][0]) == 4
+    assert set(cache.rows) == {id(s) for s in samples[6:]}
+    np.testing.assert_array_equal(cache.get_many(samples[6:]),
+                                  expected(samples[6:]))
+
+    np.testing.assert_array_equal(cache.get_many(samples[:6]),
+                                  expected(samples[:6]))
+    np.testing.assert_array_equal(cache.get_many(samples[4:]),
+                                  expected(samples[4:]))
+    assert len(cache.rows) == 4
+    assert len(cache.stores[3][0]) == 4
+
+
+def test_recently_used_rows_are_kept():
+    cache = PreparedCache(max_bytes=4 * ROW_BYTES)
+    samples = make_samples(6)
+
+    cache.get_many(samples[:4])
+    cache.get_many(samples[:1])
+    cache.get_many(samples[4:6])
+    assert set(cache.rows) == {id(s) for s in [samples[0]] + samples[3:6]}
+
+
+def test_save_and_load(tmp_path):
+    samples = make_samples(6)
+    cache = PreparedCache(str(tmp_path), max_bytes=4 * ROW_BYTES)
+    cache.get_many(samples)
+    cache.save()
+
+    loaded = PreparedCache(str(tmp_path), max_bytes=4 * ROW_BYTES)
+    assert len(loaded.digests) == 4
+    np.testing.assert_array_equal(loaded.get_many(samples[2:]),
+                                  expected(samples[2:]))
+    assert loaded.stores[3][1] == 4
+
+
+def test_update_matches_new_mincer():
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    nstream = Mincer(recognizer)
+    for sample in make_samples(40):
+        recognizer.add_template(sample)
+        nstream.update()
+
+        fresh = Mincer(recognizer)
+        np.testing.assert_array_equal(nstream.prepared, fresh.prepared)
+        np.testing.assert_array_equal(nstream.gids, fresh.gids)
+        np.testing.assert_array_equal(nstream.splices, fresh.splices)
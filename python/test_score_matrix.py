@@ -0,0 +1,142 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+
+import pickle
+
+import numpy as np
+import pytest
+
+from dataset import Dataset
+from jackknife import Jackknife
+from score_matrix import ScoreMatrix
+from tables import DeviceType
+from test_dataset import write_sample
+
+
+def make_dataset(path, unit=False):
+    """Random walks, or unit vectors, whose components are all below 1
+    and so give NaN correction factors"""
+    rng = np.random.default_rng(0)
+    for sname in ["s0", "s1", "s2"]:
+        for gname in ["g0", "g1", "g2"]:
+            gpath = path / "ds" / sname / gname
+            gpath.mkdir(parents=True)
+            for ename in ["e0", "e1", "e2"]:
+                pt_cnt = int(rng.integers(20, 40))
+                trajectory = np.cumsum(rng.normal(size=(pt_cnt, 3)), axis=0)
+                if unit:
+                    trajectory /= np.linalg.norm(
+                        trajectory, axis=1, keepdims=True)
+                write_sample(str(gpath / ename), gname, trajectory,
+                             np.arange(pt_cnt) / 30.0)
+    return Dataset.Load(str(path / "ds"), DeviceType.KINECT)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    return make_dataset(tmp_path)
+
+
+@pytest.mark.parametrize("mode", ["ud", "ui"])
+def test_classify_matches_recognizer(dataset, tmp_path, mode):
+    score_matrix = ScoreMatrix.Load(
+        dataset, 16, mode, path=str(tmp_path / mode))
+    folds = dataset.ud(1, 2) if mode == 'ud' else dataset.ui(1, 1)
+
+    for train, test in folds:
+        recognizer = Jackknife(16, dataset.device_type)
+        for sample in train:
+            recognizer.add_template(sample)
+
+        expected = recognizer.classify_many(test, best_only=True)
+        actual = score_matrix.classify(train, test)
+        for a, b in zip(expected, actual):
+            assert a[0].sample is b[0].sample
+            assert a[0].score == pytest.approx(b[0].score, abs=1e-12)
+
+
+def test_pickle_maps_saved_scores(dataset, tmp_path):
+    score_matrix = ScoreMatrix.Load(
+        dataset, 16, 'ud', path=str(tmp_path / "ud"))
+    state = pickle.dumps((dataset, score_matrix))
+
+    # Scores and column indices are left out
+    assert len(state) < len(pickle.dumps(dataset)) + \
+        score_matrix.scores.nbytes
+
+    other_dataset, other = pickle.loads(state)
+    assert other.dataset is other_dataset
+    assert isinstance(other.scores, np.memmap)
+    np.testing.assert_array_equal(other.scores, score_matrix.scores)
+
+    train, test = next(iter(dataset.ud(1, 1)))
+    other_train = [other_dataset.samples[dataset.samples.index(t)]
+                   for t in train]
+    other_test = [other_dataset.samples[dataset.samples.index(t)]
+                  for t in test]
+    for a, b in zip(score_matrix.classify(train, test),
+                    other.classify(other_train, other_test)):
+        assert a[0].score == b[0].score
+
+
+@pytest.mark.parametrize("quantile", [None, 0.3])
+def test_classify_matches_recognizer_with_nan_abs(tmp_path, quantile):
+    dataset = make_dataset(tmp_path, unit=True)
+    score_matrix = ScoreMatrix.Load(dataset, 16, 'ud')
+    threshold = np.inf
+    if quantile is not None:
+        threshold = np.quantile(score_matrix.scores, quantile)
+
+    accepted = 0
+    for train, test in dataset.ud(1, 3):
+        recognizer = Jackknife(16, dataset.device_type)
+        for sample in train:
+            recognizer.add_template(sample)
+        recognizer.set_rejection_threshold(threshold)
+
+        expected = recognizer.classify_many(test, best_only=True)
+        actual = score_matrix.classify(train, test, threshold)
+        for a, b in zip(expected, actual):
+            assert (a is None) == (b is None)
+            if a is not None:
+                accepted += 1
+                assert a[0].sample is b[0].sample
+                assert a[0].score == pytest.approx(b[0].score, abs=1e-12)
+
+    assert accepted > 0
+
+
+def test_classify_skips_nan_scores(dataset):
+    score_matrix = ScoreMatrix.Load(dataset, 16, 'ud')
+    train, test = next(iter(dataset.ud(2, 1)))
+    cols = [score_matrix.index[id(t)] for t in train]
+    expected = score_matrix.lookup([score_matrix.index[id(test[0])]], cols)
+
+    # Every score but the worst one is NaN
+    scores = np.array(score_matrix.scores)
+    row = score_matrix.index[id(test[0])]
+    start, end = score_matrix.indptr[row], score_matrix.indptr[row + 1]
+    worst = np.argmax(expected[0])
+    keep = score_matrix.indices[start:end] == cols[worst]
+    scores[start:end][~keep] = np.nan
+    score_matrix.scores = scores
+
+    result, = score_matrix.classify(train, test[:1])[0]
+    assert result.sample is train[worst]
+    assert result.score == expected[0, worst]
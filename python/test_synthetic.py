@@ -0,0 +1,252 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+
+import numpy as np
+import pytest
+
+from jackknife import Jackknife
+from synthetic import IncrementalThreshold
+from synthetic import ScoreSketch
+from synthetic import bootstrap_threshold_interval
+from synthetic import build_adjustment_table
+from synthetic import bootstrap_threshold_interval_sketch
+from synthetic import estimate_rejection_threshold
+from synthetic import merge_sorted, remove_sorted
+from synthetic import estimate_rejection_threshold_sketch
+from synthetic import select_rejection_threshold
+from tables import DeviceType
+from test_mincer import make_samples
+import synthetic
+import tables
+import utils
+
+
+def fscore(pos, neg, threshold, beta):
+    """F-beta of accepting the scores at or below threshold"""
+    tp = np.count_nonzero(pos <= threshold)
+    fp = np.count_nonzero(neg <= threshold)
+    fn = len(pos) - tp
+    b2 = beta * beta
+    return (b2 + 1) * tp / ((b2 + 1) * tp + b2 * fn + fp)
+
+
+def sketch(scores, relative_error, exact_cnt):
+    ret = ScoreSketch(relative_error=relative_error, exact_cnt=exact_cnt)
+    for chunk in np.array_split(scores, 20):
+        ret.add(chunk)
+    return ret
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("relative_error", [1e-3, 1e-2, 1e-1])
+@pytest.mark.parametrize("beta", [0.5, 1.0, 2.0])
+def test_sketch_fscore_loss_is_bounded(seed, relative_error, beta):
+    rng = np.random.default_rng(seed)
+    pos = rng.gamma(2.0, size=20000)
+    neg = rng.gamma(4.0, size=20000)
+
+    psketch = sketch(pos, relative_error, exact_cnt=100)
+    nsketch = sketch(neg, relative_error, exact_cnt=100)
+    assert not psketch.exact and not nsketch.exact
+
+    exact = estimate_rejection_threshold(pos, neg, beta)
+    approx = estimate_rejection_threshold_sketch(psketch, nsketch, beta)
+
+    # Scores sharing a bin with the exact threshold
+    k = np.searchsorted(psketch.edges, exact, side='left')
+    m = psketch.counts[k] + nsketch.counts[k]
+
+    best = fscore(pos, neg, exact, beta)
+    loss = best - fscore(pos, neg, approx, beta)
+    assert -1e-12 <= loss <= m / (beta * beta * len(pos) + m) + 1e-12
+
+
+def test_sketch_is_exact_while_scores_are_kept():
+    rng = np.random.default_rng(0)
+    pos = rng.gamma(2.0, size=500)
+    neg = rng.gamma(4.0, size=500)
+
+    psketch = sketch(pos, 1e-3, exact_cnt=1000)
+    nsketch = sketch(neg, 1e-3, exact_cnt=1000)
+    assert psketch.exact and nsketch.exact
+    assert estimate_rejection_threshold_sketch(psketch, nsketch, 1.0) == \
+        estimate_rejection_threshold(pos, neg, 1.0)
+
+
+def test_bootstrap_resamples_all_scores_up_to_max_cnt():
+    rng = np.random.default_rng(0)
+    pos = rng.gamma(2.0, size=1000)
+    neg = rng.gamma(4.0, size=800)
+
+    expected = bootstrap_threshold_interval(
+        pos, neg, 1.0, rng=np.random.default_rng(1), max_cnt=1 << 30)
+    actual = bootstrap_threshold_interval(
+        pos, neg, 1.0, rng=np.random.default_rng(1), max_cnt=1000)
+    assert actual == expected
+
+
+def test_bootstrap_subsample_scales_to_all_scores():
+    rng = np.random.default_rng(0)
+    pos = rng.gamma(2.0, size=20000)
+    neg = rng.gamma(4.0, size=20000)
+
+    threshold = estimate_rejection_threshold(pos, neg, 1.0)
+    full = bootstrap_threshold_interval(
+        pos, neg, 1.0, rng=np.random.default_rng(1), max_cnt=1 << 30)
+    lower, upper = bootstrap_threshold_interval(
+        pos, neg, 1.0, rng=np.random.default_rng(1), max_cnt=1000)
+
+    assert lower <= threshold <= upper
+    assert 0.5 < (upper - lower) / (full[1] - full[0]) < 2.0
+
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_select_rejection_threshold_counts(adaptive):
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    for sample in make_samples(6):
+        recognizer.add_template(sample)
+
+    utils.seed(0)
+    threshold, pos_cnt, neg_cnt, round_cnt = select_rejection_threshold(
+        recognizer, DeviceType.KINECT, 1.0, 1, adaptive=adaptive,
+        tolerance=0.0, max_iterations=30, return_counts=True)
+
+    assert round_cnt == (3 if adaptive else 1)
+    assert pos_cnt == neg_cnt == 6 * 10 * round_cnt
+
+    utils.seed(0)
+    assert select_rejection_threshold(
+        recognizer, DeviceType.KINECT, 1.0, 1, adaptive=adaptive,
+        tolerance=0.0, max_iterations=30) == threshold
+
+
+def test_select_rejection_threshold_workers_agree():
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    for sample in make_samples(6):
+        recognizer.add_template(sample)
+
+    thresholds = []
+    for workers in (1, 2):
+        utils.seed(0)
+        thresholds += [select_rejection_threshold(
+            recognizer, DeviceType.KINECT, 1.0, 1, workers=workers,
+            adaptive=True, tolerance=0.0, max_iterations=20)]
+    assert thresholds[0] == thresholds[1]
+
+
+def test_bootstrap_sketch_matches_scores_while_exact():
+    rng = np.random.default_rng(0)
+    pos = rng.gamma(2.0, size=500)
+    neg = rng.gamma(4.0, size=500)
+
+    assert bootstrap_threshold_interval_sketch(
+        sketch(pos, 1e-3, exact_cnt=1000),
+        sketch(neg, 1e-3, exact_cnt=1000),
+        1.0, rng=np.random.default_rng(1)) == \
+        bootstrap_threshold_interval(
+            pos, neg, 1.0, rng=np.random.default_rng(1))
+
+
+def test_bootstrap_sketch_of_bins():
+    rng = np.random.default_rng(0)
+    pos = rng.gamma(2.0, size=20000)
+    neg = rng.gamma(4.0, size=20000)
+    psketch = sketch(pos, 1e-3, exact_cnt=100)
+    nsketch = sketch(neg, 1e-3, exact_cnt=100)
+
+    threshold = estimate_rejection_threshold_sketch(psketch, nsketch, 1.0)
+    lower, upper = bootstrap_threshold_interval_sketch(
+        psketch, nsketch, 1.0, rng=np.random.default_rng(1))
+    full = bootstrap_threshold_interval(
+        pos, neg, 1.0, rng=np.random.default_rng(1), max_cnt=1 << 30)
+
+    assert lower <= threshold <= upper
+    assert 0.5 < (upper - lower) / (full[1] - full[0]) < 2.0
+    assert psketch.mean() == pytest.approx(np.mean(pos))
+
+
+def test_select_rejection_threshold_with_binned_scores(monkeypatch):
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    for sample in make_samples(6):
+        recognizer.add_template(sample)
+
+    sketches = []
+
+    def binned_sketch():
+        sketches.append(ScoreSketch(exact_cnt=100))
+        return sketches[-1]
+
+    monkeypatch.setattr(synthetic, "ScoreSketch", binned_sketch)
+    utils.seed(0)
+    threshold, pos_cnt, neg_cnt, round_cnt = select_rejection_threshold(
+        recognizer, DeviceType.KINECT, 1.0, 1, adaptive=True,
+        tolerance=0.0, max_iterations=50, return_counts=True)
+
+    assert round_cnt == 5
+    assert pos_cnt == neg_cnt == 300
+    assert np.isfinite(threshold)
+    for score_sketch in sketches:
+        assert not score_sketch.exact and score_sketch.scores == []
+
+
+def test_merge_and_remove_sorted():
+    rng = np.random.default_rng(0)
+    a = np.sort(rng.integers(0, 10, size=50).astype(float))
+    b = np.sort(rng.integers(0, 10, size=20).astype(float))
+    merged = merge_sorted(a, b)
+    np.testing.assert_array_equal(merged, np.sort(np.concatenate((a, b))))
+    np.testing.assert_array_equal(remove_sorted(merged, b), a)
+
+
+def test_incremental_threshold_matches_pools():
+    recognizer = Jackknife(16, DeviceType.KINECT)
+    utils.seed(0)
+    incremental = IncrementalThreshold(recognizer, refresh_cnt=2)
+    for sample in make_samples(12):
+        recognizer.add_template(sample)
+
+        pos = [p for p in incremental.pos if p is not None]
+        neg = [n for n in incremental.neg if n is not None]
+        if len(neg) == 0:
+            assert incremental.threshold == np.inf
+            continue
+        threshold = estimate_rejection_threshold(
+            np.concatenate(pos), np.concatenate(neg), 1.0)
+        assert incremental.threshold == threshold * incremental.scale
+
+
+def test_adjustment_table_is_reproducible(tmp_path, monkeypatch):
+    paths = [str(tmp_path / "a.csv"), str(tmp_path / "b.csv")]
+    for path in paths:
+        build_adjustment_table(path, [DeviceType.KINECT], [1, 2], [1.0],
+                               trial_cnt=20000, seed=3)
+    with open(paths[0]) as fin:
+        text = fin.read()
+    with open(paths[1]) as fin:
+        assert fin.read() == text
+    assert text.startswith("# build_adjustment_table trial_cnt=20000 seed=3")
+
+    # The header line is skipped when the table is read
+    monkeypatch.setattr(tables, "adjustments_path", paths[0])
+    monkeypatch.setattr(tables, "adjustments", None)
+    rows = [line.split(",") for line in text.splitlines()[2:]]
+    for _, train_cnt, _, adjustment in rows:
+        assert tables.get_adjustment(
+            DeviceType.KINECT, int(train_cnt), 1.0) == float(adjustment)
+    assert tables.get_adjustment(DeviceType.KINECT, 3, 1.0) is None
@@ -0,0 +1,175 @@
+# Copyright 2022 the University of Central Florida Research Foundation, Inc.
+# All rights reserved.
+#
+#     Eugene M. Taranta II <etaranta@gmail.com>
+#     Mykola Maslych <maslychm@knights.ucf.edu>
+#     Ryan Ghamandi <ryanghamandi1@gmail.com>
+#     Joseph J. LaViola Jr. <jjl@cs.ucf.edu>
+#
+# Subject to the terms and conditions of the Florida Public Educational
+# Institution non-exclusive software license, this software is distributed
+# under a non-exclusive, royalty-free, non-sublicensable, non-commercial,
+# non-exclusive, academic research license, and is distributed without warranty
+# of any kind express or implied.
+#
+# The Florida Public Educational Institution non-exclusive software license
+# is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
+
+
+import random
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def rcma_reference(pts, w, r=1):
+    """The original point by point recursive centered moving average"""
+    n = len(pts)
+    for _ in range(r):
+        ret = []
+        for ii in range(n):
+            tot = 0.0
+            cnt = 0.0
+            for jj in range(-w, w + 1):
+                if ii + jj < 0:
+                    continue
+                if ii + jj >= n:
+                    continue
+                tot += pts[ii + jj]
+                cnt += 1.0
+            ret += [tot / cnt]
+        pts = np.array(ret)
+    return pts
+
+
+def path_length_reference(pts):
+    """The original running total of segment norms"""
+    ret = 0.0
+    for idx in range(1, len(pts)):
+        ret += np.linalg.norm(pts[idx] - pts[idx - 1])
+    return ret
+
+
+def uniform_resample_reference(pts, n, variance=0.0):
+    """The original point by point resampler"""
+    scale = (12 * variance) ** .5
+    intervals = [1.0 + random.uniform(0, 1) * scale for ii in range(n - 1)]
+    total = sum(intervals)
+    intervals = [val / total for val in intervals]
+
+    ret = np.empty((n, len(pts[0])))
+    ret[0] = pts[0]
+    path_distance = path_length_reference(pts)
+    jj = 1
+
+    accumulated_distance = 0.0
+    interval = path_distance * intervals[jj - 1]
+
+    for ii in range(1, len(pts)):
+
+        distance = np.linalg.norm(pts[ii] - pts[ii - 1])
+
+        if accumulated_distance + distance < interval:
+            accumulated_distance += distance
+            continue
+
+        previous = pts[ii - 1]
+        while accumulated_distance + distance >= interval:
+            remaining = interval - accumulated_distance
+            t = remaining / distance
+            t = min(max(t, 0.0), 1.0)
+            if not np.isfinite(t):
+                t = 0.5
+
+            ret[jj] = (1.0 - t) * previous + t * pts[ii]
+
+            distance = distance - remaining
+            accumulated_distance = 0.0
+            previous = ret[jj]
+            jj += 1
+
+            if jj == n:
+                break
+
+            interval = path_distance * intervals[jj - 1]
+
+        accumulated_distance = distance
+
+    if jj < n:
+        ret[n - 1] = pts[ii - 1]
+        jj += 1
+
+    assert jj == n
+    return ret
+
+
+def random_path(rng, m, d):
+    """Random walk, some with repeated points"""
+    pts = np.cumsum(rng.normal(size=(m, d)), axis=0)
+    if rng.uniform() < 0.3:
+        pts[rng.integers(0, m, m // 4)] = pts[0]
+    return pts
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("d", [2, 3, 63])
+def test_path_length_matches_reference(seed, d):
+    rng = np.random.default_rng(seed)
+    pts = random_path(rng, int(rng.integers(2, 200)), d)
+    assert utils.path_length(pts) == path_length_reference(pts)
+
+
+@pytest.mark.parametrize("n", [16, 20, 64, 128])
+@pytest.mark.parametrize("variance", [0.0, 0.25])
+def test_uniform_resample_matches_reference(n, variance):
+    rng = np.random.default_rng(n)
+    for seed in range(50):
+        pts = random_path(rng, int(rng.integers(2, 200)), 6)
+
+        random.seed(seed)
+        expected = uniform_resample_reference(pts, n, variance)
+        random.seed(seed)
+        resampled = utils.uniform_resample(pts, n, variance)
+
+        # Interior points are interpolated in a different order; the
+        # last point is the same input point whenever the loop ends short
+        np.testing.assert_allclose(resampled, expected, rtol=0, atol=1e-9)
+        if np.array_equal(expected[-1], pts[-2]):
+            np.testing.assert_array_equal(resampled[-1], pts[-2])
+
+
+@pytest.mark.parametrize("n", [16, 128])
+def test_uniform_resample_many_matches_uniform_resample(n):
+    rng = np.random.default_rng(n)
+    batch = np.cumsum(rng.normal(size=(20, 50, 3)), axis=1)
+
+    resampled = utils.uniform_resample_many(batch, n)
+    for pts, expected in zip(batch, resampled):
+        np.testing.assert_allclose(uniform_resample_reference(pts, n),
+                                   expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("n", [1, 2, 3, 7, 60])
+@pytest.mark.parametrize("w", [1, 2, 5])
+@pytest.mark.parametrize("r", [1, 4, 38])
+def test_rcma_matches_reference(n, w, r):
+    rng = np.random.default_rng(n * 100 + w * 10 + r)
+    pts = rng.normal(size=(n, 3))
+
+    np.testing.assert_array_equal(utils.rcma(pts, w, r),
+                                  rcma_reference(pts, w, r))
+
+
+@pytest.mark.parametrize("n", [1, 5, 60])
+@pytest.mark.parametrize("w", [1, 3])
+def test_rcma_batch_matches_rcma(n, w):
+    rng = np.random.default_rng(n * 10 + w)
+    batch = rng.normal(size=(4, n, 63))
+
+    filtered = utils.rcma_batch(batch, w, 38)
+
+    assert filtered.shape == batch.shape
+    for pts, expected in zip(batch, filtered):
+        np.testing.assert_array_equal(utils.rcma(pts, w, 38), expected)
@@ -16,17 +16,31 @@
 # is located at <https://github.com/ISUE/VKM/blob/main/LICENSE>.
 
 
-from typing import Union
+from typing import List, Union
 import numpy as np
 import random
 
 
+# Shared generator for vectorized random draws; see seed().
+rng = np.random.default_rng()
+
+
+def seed(value=None):
+    """Seed the random module and the shared numpy generator."""
+    global rng
+    random.seed(value)
+    rng = np.random.default_rng(value)
+
+
 def norm_diagonal(pts: list):
+    """Normalized bounding box diagonal; also of a (k, n, d) stack"""
     pts = np.array(pts)
-    minimum = np.min(pts, axis=0)
-    maximum = np.max(pts, axis=0)
+    minimum = np.min(pts, axis=-2)
+    maximum = np.max(pts, axis=-2)
     delta = maximum - minimum
-    return delta / np.linalg.norm(delta)
+    if delta.ndim == 1:
+        return delta / np.linalg.norm(delta)
+    return delta / np.linalg.norm(delta, axis=-1, keepdims=True)
 
 
 def diagonal(pts: list):
@@ -37,95 +51,191 @@ def diagonal(pts: list):
 
 
 def norm_comp_len(pts):
-    """Component-wise absolute distance"""
+    """Component-wise absolute distance; also of a (k, n, d) stack
+
+    The sums are accumulated in integers, and adding a float to an integer
+    total truncates, so each point adds the floor of its magnitude.
+    """
     pts = np.array(pts)
-    abs_comp_len = np.full(pts.shape[1], 0)
-    for p in pts:
-        for idx, m in enumerate(p):
-            abs_comp_len[idx] += abs(m)
-    return abs_comp_len / np.linalg.norm(abs_comp_len)
+    abs_comp_len = np.sum(np.floor(np.abs(pts)), axis=-2).astype(np.int64)
+    if abs_comp_len.ndim == 1:
+        return abs_comp_len / np.linalg.norm(abs_comp_len)
+    return abs_comp_len / np.linalg.norm(
+        abs_comp_len, axis=-1, keepdims=True)
 
 
 def path_length(pts):
     """ """
-    cnt = len(pts)
-    ret = 0.0
-    for idx in range(1, cnt):
-        ret += np.linalg.norm(pts[idx] - pts[idx - 1])
-
-    return ret
-
-
-def uniform_resample(pts: Union[list, np.ndarray],
-                     n: int,
-                     variance: float = 0.0) -> np.ndarray:
-    """ """
-    #
-    # create random intervals
-    #
-    scale = (12 * variance) ** .5
-    intervals = [1.0 + random.uniform(0, 1) * scale for ii in range(n - 1)]
-    total = sum(intervals)
-    intervals = [val / total for val in intervals]
-
-    # Setup place to store resampled points, and
-    # store first point. jj indexes the return matrix
-    ret = np.empty((n, len(pts[0])))
-    ret[0] = pts[0]
-    path_distance = path_length(pts)
+    pts = np.asarray(pts, dtype=float)
+    if len(pts) < 2:
+        return 0.0
+
+    # Segment lengths summed in order, as a running total would
+    return float(np.add.accumulate(segment_lengths(pts))[-1])
+
+
+def segment_lengths(pts: np.ndarray) -> np.ndarray:
+    """Length of every segment along the second to last axis.
+
+    Each length is the square root of the segment's dot product with
+    itself, as np.linalg.norm computes it for one vector, so the lengths
+    are bit-for-bit those of a per-segment norm.
+    """
+    diff = np.diff(pts, axis=-2)
+    sqnorm = np.matmul(diff[..., np.newaxis, :], diff[..., :, np.newaxis])
+    return np.sqrt(sqnorm[..., 0, 0])
+
+
+def reaches_end(lengths: List[float],
+                path_distance: float,
+                intervals: List[float]) -> bool:
+    """True if stepping along the path by intervals emits the last point
+    before the path runs out.
+
+    Replays the running distance arithmetic of the point-by-point
+    resampler. In exact arithmetic the last point is always reached; with
+    rounding, about half the paths fall short, and the resampler then
+    ends them at the second to last input point instead.
+    """
+    n = len(intervals) + 1
     jj = 1
-
-    # now do resampling
     accumulated_distance = 0.0
     interval = path_distance * intervals[jj - 1]
 
-    for ii in range(1, len(pts)):
-
-        distance = np.linalg.norm(pts[ii] - pts[ii - 1])
-
+    for distance in lengths:
         if accumulated_distance + distance < interval:
             accumulated_distance += distance
             continue
 
-        previous = pts[ii - 1]
         while accumulated_distance + distance >= interval:
-
-            # Now we need to interpolate between the last point
-            # and the current point.
             remaining = interval - accumulated_distance
-            t = remaining / distance
-
-            # Handle any precision errors. Note that the distance can
-            # be zero if two samples are sufficiently close together,
-            # which can result in nan.
-            t = min(max(t, 0.0), 1.0)
-            if not np.isfinite(t):
-                t = 0.5
-
-            ret[jj] = (1.0 - t) * previous + t * pts[ii]
-
-            # Reduce the distances based on how much path we
-            # just consumed.
             distance = distance - remaining
             accumulated_distance = 0.0
-            previous = ret[jj]
             jj += 1
-
-            # Exit early so we don't go past end
-            # of the intervals array.
             if jj == n:
-                break
-
-            # select next interval
+                return True
             interval = path_distance * intervals[jj - 1]
 
         accumulated_distance = distance
 
-    if jj < n:
-        ret[n - 1] = pts[ii - 1]
-        jj += 1
+    return False
+
 
-    assert jj == n
+def last_points(pts: np.ndarray,
+                lengths: np.ndarray,
+                intervals: np.ndarray) -> np.ndarray:
+    """Last resampled point of pts for every row of intervals, see
+    reaches_end"""
+    if len(pts) < 2:
+        return np.broadcast_to(pts[-1], intervals.shape[:-1] + pts[-1].shape)
+
+    path_distance = float(np.add.accumulate(lengths)[-1])
+    lengths = lengths.tolist()
+    rows = intervals.reshape(-1, intervals.shape[-1]).tolist()
+    reached = np.array(
+        [reaches_end(lengths, path_distance, row) for row in rows],
+        dtype=bool).reshape(intervals.shape[:-1] + (1,))
+    return np.where(reached, pts[-1], pts[-2])
+
+
+def uniform_resample(pts: Union[list, np.ndarray],
+                     n: int,
+                     variance: float = 0.0) -> np.ndarray:
+    """Resample pts to n points spaced along the path by random intervals.
+
+    With variance=0 the points are equidistant along the path.
+    """
+    #
+    # create random intervals
+    #
+    scale = (12 * variance) ** .5
+    intervals = [1.0 + random.uniform(0, 1) * scale for ii in range(n - 1)]
+    total = sum(intervals)
+    intervals = [val / total for val in intervals]
+
+    return resample_intervals(pts, np.array(intervals))
+
+
+def resample_intervals(pts: Union[list, np.ndarray],
+                       intervals: np.ndarray) -> np.ndarray:
+    """Resample pts at the given normalized path intervals.
+
+    intervals has shape (..., n - 1) and each row sums to one; the result
+    has shape (..., n, d). The path's arc length table is computed once and
+    shared by all rows.
+    """
+    pts = np.asarray(pts, dtype=float)
+    n = intervals.shape[-1] + 1
+
+    # Cumulative arc length at every input point. Segment ii runs from
+    # pts[ii - 1] to pts[ii].
+    lengths = segment_lengths(pts)
+    arc = np.concatenate(([0.0], np.cumsum(lengths)))
+    path_distance = arc[-1]
+
+    # Arc position of every resampled point between the first, which is
+    # the start of the path, and the last; see last_points.
+    targets = np.cumsum(path_distance * intervals[..., :-1], axis=-1)
+
+    # Locate the segment that contains each target. Searching from the
+    # left skips zero-length segments, as they never reach the target.
+    ii = np.searchsorted(arc, targets, side='left')
+    ii = np.clip(ii, 1, len(pts) - 1)
+
+    # Now we need to interpolate within that segment. Handle any
+    # precision errors. Note that the distance can be zero if two samples
+    # are sufficiently close together, which can result in nan.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (targets - arc[ii - 1]) / lengths[ii - 1]
+    t = np.clip(t, 0.0, 1.0)
+    t[~np.isfinite(t)] = 0.5
+    t = t[..., np.newaxis]
+
+    ret = np.empty(intervals.shape[:-1] + (n, pts.shape[1]))
+    ret[..., 0, :] = pts[0]
+    ret[..., 1:-1, :] = (1.0 - t) * pts[ii - 1] + t * pts[ii]
+    ret[..., -1, :] = last_points(pts, lengths, intervals)
+    return ret
+
+
+def uniform_resample_many(batch: np.ndarray,
+                          n: int) -> np.ndarray:
+    """uniform_resample(pts, n) of each path in a (k, m, d) stack
+
+    Points are equidistant along each path, as with variance=0; no
+    random numbers are drawn.
+    """
+    batch = np.asarray(batch, dtype=float)
+    m = batch.shape[-2]
+    intervals = np.full(n - 1, 1.0 / (n - 1))
+
+    lengths = segment_lengths(batch)
+    arc = np.zeros(lengths.shape[:-1] + (m,))
+    np.cumsum(lengths, axis=-1, out=arc[..., 1:])
+    path_distance = arc[..., -1:]
+
+    # As in resample_intervals, per path; the segment index is the number
+    # of arc positions below the target, i.e. a left-sided search.
+    targets = np.cumsum(path_distance * intervals[:-1], axis=-1)
+    ii = np.sum(arc[..., np.newaxis, :] < targets[..., np.newaxis], axis=-1)
+    ii = np.clip(ii, 1, m - 1)
+
+    start = np.take_along_axis(arc, ii - 1, axis=-1)
+    length = np.take_along_axis(lengths, ii - 1, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (targets - start) / length
+    t = np.clip(t, 0.0, 1.0)
+    t[~np.isfinite(t)] = 0.5
+    t = t[..., np.newaxis]
+
+    previous = np.take_along_axis(batch, ii[..., np.newaxis] - 1, axis=-2)
+    current = np.take_along_axis(batch, ii[..., np.newaxis], axis=-2)
+
+    ret = np.empty(batch.shape[:-2] + (n, batch.shape[-1]))
+    ret[..., 0, :] = batch[..., 0, :]
+    ret[..., 1:-1, :] = (1.0 - t) * previous + t * current
+    for idx in np.ndindex(batch.shape[:-2]):
+        ret[idx + (-1,)] = last_points(batch[idx], lengths[idx], intervals)
     return ret
 
 
@@ -141,22 +251,40 @@ def get_cma_r(fs, fc):
 
 
 def rcma(pts, w, r=1):
+    """Recursive centered moving average along the first axis.
+
+    Each of the r passes averages the 2w+1 points centered on every point,
+    shrinking the window at both ends. Sums are accumulated in the same
+    order as a point-by-point loop, so results are bit-for-bit identical.
+    """
+    return _rcma(np.asarray(pts, dtype=float), w, r, axis=0)
+
+
+def rcma_batch(batch, w, r=1):
+    """rcma of a (k, n, ...) stack of equal length trajectories."""
+    return _rcma(np.asarray(batch, dtype=float), w, r, axis=1)
+
+
+def _rcma(pts: np.ndarray, w: int, r: int, axis: int) -> np.ndarray:
+    pts = np.moveaxis(pts, axis, 0)
     n = len(pts)
+
+    idx = np.arange(n)
+    cnt = np.minimum(idx + w, n - 1) - np.maximum(idx - w, 0) + 1.0
+    cnt = cnt.reshape((n,) + (1,) * (pts.ndim - 1))
+
     for _ in range(r):
-        ret = []
-        for ii in range(n):
-            tot = 0.0
-            cnt = 0.0
-            for jj in range(-w, w + 1):
-                if ii + jj < 0:
-                    continue
-                if ii + jj >= n:
-                    continue
-                tot += pts[ii + jj]
-                cnt += 1.0
-            ret += [tot / cnt]
-        pts = np.array(ret)
-    return pts
+        tot = np.zeros_like(pts)
+        for jj in range(-w, w + 1):
+            if abs(jj) >= n:
+                continue
+            if jj < 0:
+                tot[-jj:] += pts[:n + jj]
+            else:
+                tot[:n - jj] += pts[jj:]
+        pts = tot / cnt
+
+    return np.moveaxis(pts, 0, axis)
 
 
 def zero_vector(dimensions: int):